@@ -5,3 +5,4 @@
 # Author: Yanshuai Cao
 
 from .tracker import LTParser
+from .index import search
@@ -0,0 +1,618 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from os.path import join as pjoin
+
+import lite_tracer.packs as packs
+import lite_tracer.store as store
+from lite_tracer.hashing import (CHUNK_SIZE, DEFAULT_ALGORITHM, RACY_SECONDS,
+                                 file_digest, new_hash)
+from lite_tracer.records import SETTINGS_FILE, Parsed, RecordEntry, scan_records
+
+STORAGE_KINDS = ('dir', 'sqlite', 'objects')
+SQLITE_FILE = 'records.sqlite'
+OBJECTS_DIR = 'objects'
+
+
+def open_storage(lt_dir, kind='dir', algorithm=DEFAULT_ALGORITHM, sharded=None):
+    """Backend keeping the records of lt_dir
+
+    dir is the usual directory per record, sqlite keeps everything in
+    lt_dir/records.sqlite and objects in an object store, here the local
+    stand-in lt_dir/objects. sharded only applies to dir, see LocalBackend.
+    """
+    if kind == 'dir':
+        return LocalBackend(lt_dir, algorithm, sharded)
+    if kind == 'sqlite':
+        return SqliteBackend(pjoin(lt_dir, SQLITE_FILE), algorithm)
+    if kind == 'objects':
+        return ObjectStoreBackend(LocalObjectClient(pjoin(lt_dir, OBJECTS_DIR)),
+                                  algorithm)
+
+    raise ValueError('storage needs to be [{}]'.format('/'.join(STORAGE_KINDS)))
+
+
+def _spool(src_path, algorithm):
+    """Copies src_path to a temporary file in CHUNK_SIZE pieces, hashing it
+    on the way, returns (digest, size, copy)
+
+    The copy is what gets stored, so a blob always matches its digest even
+    if src_path changes meanwhile. Small files stay in memory.
+    """
+    digest = new_hash(algorithm)
+    spool = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE)
+    with open(src_path, 'rb') as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+
+    size = spool.tell()
+    spool.seek(0)
+    return digest.hexdigest(), size, spool
+
+
+class RecordBackend(object):
+    """Where records and the blobs of their untracked files are kept
+
+    A record is a few named text files, written all at once: the settings,
+    diff.patch and untracked.manifest. Blobs are keyed by their digest.
+
+    Attributes:
+    algorithm (str): Hash algorithm the blobs are keyed by
+    """
+    algorithm = DEFAULT_ALGORITHM
+
+    def location(self, hash_code):
+        """Where a record is, e.g. to tell the user"""
+        raise NotImplementedError
+
+    def has_record(self, hash_code):
+        raise NotImplementedError
+
+    def write_record(self, hash_code, files, links=()):
+        """Replaces the record with files [(name, text)] and the local files
+        of links [(name, path)], readers see the old or the new record"""
+        raise NotImplementedError
+
+    def read_file(self, hash_code, name):
+        """Text of a record file, None if the record does not have it"""
+        raise NotImplementedError
+
+    def read_patch(self, hash_code):
+        """Patch of the uncommitted changes of a record, None without any"""
+        return self.read_file(hash_code, store.PATCH_FILE)
+
+    def list_records(self):
+        """Yields a RecordEntry per record"""
+        raise NotImplementedError
+
+    def stamp(self):
+        """Changes whenever records change, None when that is not known"""
+        return None
+
+    def has_blob(self, digest):
+        raise NotImplementedError
+
+    def put_blob(self, src_path, digest=None):
+        """Stores the content of src_path unless the blob of digest, its
+        digest when hashed, is stored already. Returns the digest of what
+        was stored, see _spool"""
+        raise NotImplementedError
+
+    def get_blob(self, digest, algorithm=None):
+        """Content of a blob, of the backend's algorithm by default"""
+        raise NotImplementedError
+
+    def link_blob(self, digest, dst_path, algorithm=None):
+        """Materialises a blob at dst_path"""
+        data = self.get_blob(digest, algorithm)
+        dst_dir = os.path.dirname(dst_path)
+        if dst_dir:
+            store.makedirs(dst_dir)
+        with open(dst_path, 'wb') as dst_file:
+            dst_file.write(data)
+
+    def copy_legacy_untracked(self, hash_code, dst_dir):
+        """Copies the untracked files of a record made before the blob
+        store into dst_dir, returns whether it had any"""
+        return False
+
+    def settings_path(self, hash_code):
+        return pjoin(self.location(hash_code), SETTINGS_FILE.format(hash_code))
+
+    def parse_record(self, entry):
+        """Parsed of a listed record, like records.parse_setting_file"""
+        name = SETTINGS_FILE.format(entry.hash_str)
+        settings = self.read_file(entry.hash_str, os.path.splitext(name)[0] + '.json')
+        if settings is not None:
+            return Parsed.from_settings(entry.settings_path, json.loads(settings),
+                                        entry.hash_str, entry.ctime)
+
+        lines = (self.read_file(entry.hash_str, name) or '').splitlines(True)
+        return Parsed(entry.settings_path, lines[0] if lines else '',
+                      entry.hash_str, entry.ctime)
+
+    @staticmethod
+    def _read_links(files, links):
+        files = list(files)
+        for name, path in links:
+            with open(path, 'rb') as link_file:
+                files.append((name, link_file.read().decode('utf-8')))
+
+        return files
+
+    def _entry(self, hash_code, ctime, version):
+        return RecordEntry(hash_code, self.settings_path(hash_code), ctime,
+                           version, self)
+
+
+class LocalBackend(RecordBackend):
+    """A directory per record under lt_dir, blobs in lt_dir/blobs
+
+    Linked files are hardlinked into the record, records are assembled in a
+    temp dir and renamed into place. Records are written to
+    lt_dir/<shard>/<hash_code> in the sharded layout, to lt_dir/<hash_code>
+    otherwise, and are read from either or from the packs of lt_dir, see
+    packs.pack_records. A loose record shadows a packed copy of it.
+
+    Attributes:
+    lt_dir (str): Folder containing the LT records
+    sharded (bool): Whether new records go to the sharded layout, that of
+        lt_dir by default. True also switches lt_dir to it
+    """
+    def __init__(self, lt_dir, algorithm=DEFAULT_ALGORITHM, sharded=None):
+        self.lt_dir = lt_dir
+        self.algorithm = algorithm
+        self.blob_store = store.BlobStore(pjoin(lt_dir, 'blobs'), algorithm)
+
+        if sharded and not store.is_sharded(lt_dir):
+            store.makedirs(lt_dir)
+            with open(pjoin(lt_dir, store.SHARDED_FILE), 'a'):
+                pass
+        self.sharded = store.is_sharded(lt_dir) if sharded is None else sharded
+        self._packs = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_packs'] = None
+        return state
+
+    def location(self, hash_code):
+        """Path of the record, where it is written in the current layout"""
+        sharded_path, flat_path = store.record_paths(self.lt_dir, hash_code)
+        return sharded_path if self.sharded else flat_path
+
+    def has_record(self, hash_code):
+        return (store.find_record(self.lt_dir, hash_code) is not None or
+                self._packed(hash_code) is not None)
+
+    def write_record(self, hash_code, files, links=()):
+        record_path = self.location(hash_code)
+        if self.sharded:
+            store.makedirs(os.path.dirname(record_path))
+
+        tmp_path = store.make_temp_dir(self.lt_dir)
+        try:
+            for name, path in links:
+                store.link_or_copy(path, pjoin(tmp_path, name))
+
+            for name, text in files:
+                with open(pjoin(tmp_path, name), 'w') as write_file:
+                    write_file.write(text)
+
+            # Packing renames records aside, not while one is overwritten
+            store.commit_dir(tmp_path, record_path, packs.lock_path(self.lt_dir))
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        # An older copy in the other layout would be listed as well
+        for other_path in store.record_paths(self.lt_dir, hash_code):
+            if other_path != record_path and os.path.isdir(other_path):
+                shutil.rmtree(other_path, ignore_errors=True)
+
+        store.bump_generation(self.lt_dir)
+
+    def read_file(self, hash_code, name):
+        record_path = store.find_record(self.lt_dir, hash_code)
+        if record_path is not None:
+            return store.read_record_file(record_path, name)
+
+        pack = self._packed(hash_code)
+        if pack is None:
+            return None
+
+        return packs.read_file(pack.read(hash_code), name)
+
+    def read_patch(self, hash_code):
+        record_path = store.find_record(self.lt_dir, hash_code)
+        if record_path is not None:
+            return store.read_patch(record_path, self.blob_store.root)
+
+        pack = self._packed(hash_code)
+        if pack is None:
+            return None
+
+        files = pack.read(hash_code)
+        patch = packs.read_file(files, store.PATCH_FILE)
+        if patch is not None:
+            return patch
+
+        return store.patch_from_delta(packs.read_file(files, store.DELTA_FILE),
+                                      self.blob_store.root)
+
+    def copy_legacy_untracked(self, hash_code, dst_dir):
+        record_path = store.find_record(self.lt_dir, hash_code)
+        if record_path is not None:
+            untracked_path = pjoin(record_path, store.LEGACY_UNTRACKED_DIR)
+            if not os.path.isdir(untracked_path):
+                return False
+            shutil.copytree(untracked_path, dst_dir, symlinks=True,
+                            dirs_exist_ok=True)
+            return True
+
+        pack = self._packed(hash_code)
+        if pack is None:
+            return False
+
+        prefix = store.LEGACY_UNTRACKED_DIR + '/'
+        copied = False
+        for name, data in pack.read(hash_code).items():
+            if not name.startswith(prefix):
+                continue
+            dst_path = pjoin(dst_dir, *name[len(prefix):].split('/'))
+            store.makedirs(os.path.dirname(dst_path))
+            with open(dst_path, 'wb') as dst_file:
+                dst_file.write(data)
+            copied = True
+
+        return copied
+
+    def list_records(self):
+        """Loose records as they are listed, then packed ones"""
+        listed = set()
+        for entry in scan_records(self.lt_dir):
+            listed.add(entry.hash_str)
+            yield entry
+
+        for pack in self._load_packs():
+            for hash_code, (_, _, ctime, mtime_ns) in pack.entries.items():
+                if hash_code in listed:
+                    continue
+                listed.add(hash_code)
+                settings_path = pjoin(pack.pack_path, hash_code,
+                                      SETTINGS_FILE.format(hash_code))
+                yield RecordEntry(hash_code, settings_path, ctime, mtime_ns, self)
+
+    def stamp(self):
+        """mtimes of lt_dir and of its generation file, None when racy"""
+        mtimes = list()
+        for path in (self.lt_dir, pjoin(self.lt_dir, store.GENERATION_FILE)):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(0)
+
+        if time.time() - max(mtimes) / 1e9 < RACY_SECONDS:
+            return None
+
+        return ':'.join(str(m) for m in mtimes)
+
+    def has_blob(self, digest):
+        return self.blob_store.has(digest)
+
+    def put_blob(self, src_path, digest=None):
+        return self.blob_store.put(src_path, digest)
+
+    def get_blob(self, digest, algorithm=None):
+        return self._blob_store(algorithm).get_bytes(digest)
+
+    def link_blob(self, digest, dst_path, algorithm=None):
+        """Hardlinks the blob when possible"""
+        self._blob_store(algorithm).link(digest, dst_path)
+
+    def _blob_store(self, algorithm):
+        if algorithm is None or algorithm == self.algorithm:
+            return self.blob_store
+
+        return store.BlobStore(self.blob_store.root, algorithm)
+
+    def _packed(self, hash_code):
+        """Newest pack holding a record"""
+        for pack in self._load_packs():
+            if hash_code in pack.entries:
+                return pack
+
+        return None
+
+    def _load_packs(self):
+        """Packs of lt_dir, only reloaded when a pack was added since"""
+        try:
+            packs_mtime = os.stat(pjoin(self.lt_dir, packs.PACKS_DIR)).st_mtime_ns
+        except OSError:
+            packs_mtime = None
+
+        # Stat first, a pack added while loading is seen by the next call
+        if self._packs is None or self._packs[0] != packs_mtime:
+            self._packs = (packs_mtime, packs.load_packs(self.lt_dir))
+
+        return self._packs[1]
+
+
+class SqliteBackend(RecordBackend):
+    """Every record and blob in a single sqlite file
+
+    Each thread and process opens its own connection, the file is in WAL
+    mode so searches do not wait on writers.
+    """
+    def __init__(self, db_path, algorithm=DEFAULT_ALGORITHM):
+        self.db_path = db_path
+        self.algorithm = algorithm
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'db_path': self.db_path, 'algorithm': self.algorithm}
+
+    def __setstate__(self, state):
+        self.__init__(state['db_path'], state['algorithm'])
+
+    @property
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                store.makedirs(db_dir)
+            db = self._local.db = sqlite3.connect(self.db_path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS records '
+                           '(hash_code TEXT PRIMARY KEY, ctime REAL, '
+                           'version INTEGER)')
+                db.execute('CREATE TABLE IF NOT EXISTS files '
+                           '(hash_code TEXT, name TEXT, content TEXT, '
+                           'PRIMARY KEY (hash_code, name))')
+                db.execute('CREATE TABLE IF NOT EXISTS blobs '
+                           '(algorithm TEXT, digest TEXT, data BLOB, '
+                           'PRIMARY KEY (algorithm, digest))')
+
+        return db
+
+    def location(self, hash_code):
+        return pjoin(self.db_path, hash_code)
+
+    def has_record(self, hash_code):
+        return self._db.execute('SELECT 1 FROM records WHERE hash_code = ?',
+                                (hash_code,)).fetchone() is not None
+
+    def write_record(self, hash_code, files, links=()):
+        files = self._read_links(files, links)
+        db = self._db
+        with db:
+            db.execute('DELETE FROM files WHERE hash_code = ?', (hash_code,))
+            db.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                           [(hash_code, name, text) for name, text in files])
+            db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?)',
+                       (hash_code, time.time(), time.time_ns()))
+
+    def read_file(self, hash_code, name):
+        row = self._db.execute(
+            'SELECT content FROM files WHERE hash_code = ? AND name = ?',
+            (hash_code, name)).fetchone()
+        return row[0] if row else None
+
+    def list_records(self):
+        for hash_code, ctime, version in self._db.execute(
+                'SELECT hash_code, ctime, version FROM records'):
+            yield self._entry(hash_code, ctime, version)
+
+    def stamp(self):
+        return ':'.join(str(v) for v in self._db.execute(
+            'SELECT COUNT(*), MAX(version) FROM records').fetchone())
+
+    def has_blob(self, digest):
+        return self._db.execute(
+            'SELECT 1 FROM blobs WHERE algorithm = ? AND digest = ?',
+            (self.algorithm, digest)).fetchone() is not None
+
+    def put_blob(self, src_path, digest=None):
+        if digest is None:
+            digest = file_digest(src_path, self.algorithm)
+        if self.has_blob(digest):
+            return digest
+
+        digest, size, spool = _spool(src_path, self.algorithm)
+        with spool, self._db as db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO blobs VALUES (?, ?, zeroblob(?))',
+                (self.algorithm, digest, size))
+            if cursor.rowcount and hasattr(db, 'blobopen'):
+                with db.blobopen('blobs', 'data', cursor.lastrowid) as blob:
+                    for chunk in iter(lambda: spool.read(CHUNK_SIZE), b''):
+                        blob.write(chunk)
+            elif cursor.rowcount:
+                # No incremental blob I/O before Python 3.11
+                db.execute('UPDATE blobs SET data = ? WHERE rowid = ?',
+                           (sqlite3.Binary(spool.read()), cursor.lastrowid))
+
+        return digest
+
+    def get_blob(self, digest, algorithm=None):
+        row = self._db.execute(
+            'SELECT data FROM blobs WHERE algorithm = ? AND digest = ?',
+            (algorithm or self.algorithm, digest)).fetchone()
+        if row is None:
+            raise IOError('No blob {}'.format(digest))
+
+        return bytes(row[0])
+
+
+class LocalObjectClient(object):
+    """Object store client over a local directory, a stand-in for a shared
+    object store in tests and single machine setups
+
+    Any client with the same put/get/exists/delete/list/url methods can be
+    given to ObjectStoreBackend, put being given bytes or a file object.
+
+    Attributes:
+    root (str): Directory holding an object per file
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def url(self, key):
+        return pjoin(self.root, key)
+
+    def put(self, key, data):
+        """Writes an object from bytes or a binary file object, atomically
+        replacing any previous one"""
+        path = self.url(key)
+        store.makedirs(os.path.dirname(path))
+        with store.atomic_write(path) as tmp_file:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, tmp_file, CHUNK_SIZE)
+            else:
+                tmp_file.write(data)
+
+    def get(self, key):
+        """Content of an object, None if it does not exist"""
+        try:
+            with open(self.url(key), 'rb') as object_file:
+                return object_file.read()
+        except (IOError, OSError):
+            return None
+
+    def exists(self, key):
+        return os.path.isfile(self.url(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.url(key))
+        except OSError:
+            pass
+
+    def list(self, prefix):
+        """Yields (key, mtime) of the objects under prefix"""
+        for dir_path, _, file_names in os.walk(self.url(prefix)):
+            for file_name in file_names:
+                if file_name.startswith('.tmp-'):
+                    continue
+                path = pjoin(dir_path, file_name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), mtime
+
+
+class ObjectStoreBackend(RecordBackend):
+    """Records and blobs as objects of an object store
+
+    The files of a record go to records/<hash>/<version>/<name>, then the
+    commit object index/<hash> is replaced to point at that version. Object
+    stores only replace single objects atomically, readers go through the
+    commit object so they never mix two versions of a record. Replaced
+    versions stay in the store for the readers still on them until collect
+    deletes them. Listing the records is a single listing of index/.
+
+    Attributes:
+    client: put/get/exists/delete/list/url client, see LocalObjectClient
+    """
+    def __init__(self, client, algorithm=DEFAULT_ALGORITHM):
+        self.client = client
+        self.algorithm = algorithm
+
+    def location(self, hash_code):
+        return self.client.url('records/' + hash_code)
+
+    def has_record(self, hash_code):
+        return self.client.exists('index/' + hash_code)
+
+    def write_record(self, hash_code, files, links=()):
+        files = self._read_links(files, links)
+        version = uuid.uuid4().hex
+        for name, text in files:
+            self.client.put('records/{}/{}/{}'.format(hash_code, version, name),
+                            text.encode('utf-8'))
+
+        commit = {'version': version, 'files': [name for name, _ in files],
+                  'ctime': time.time()}
+        self.client.put('index/' + hash_code, json.dumps(commit).encode('utf-8'))
+
+    def collect(self, grace=3600, now=None):
+        """Deletes the versions of records replaced more than grace seconds
+        ago, returns the number of objects deleted
+
+        Readers still reading a replaced version have grace seconds to
+        finish, versions being written are not committed yet and are kept as
+        long as they are younger than grace.
+        """
+        now = time.time() if now is None else now
+        commits = dict()
+        deleted = 0
+        for key, mtime in list(self.client.list('records/')):
+            hash_code, version = key.split('/')[1:3]
+            if hash_code not in commits:
+                commits[hash_code] = self._commit(hash_code)
+            commit = commits[hash_code]
+            if (commit is None or version == commit['version'] or
+                    now - commit['ctime'] < grace or now - mtime < grace):
+                continue
+            self.client.delete(key)
+            deleted += 1
+
+        return deleted
+
+    def read_file(self, hash_code, name):
+        commit = self._commit(hash_code)
+        if commit is None or name not in commit['files']:
+            return None
+
+        data = self.client.get('records/{}/{}/{}'.format(
+            hash_code, commit['version'], name))
+        return data.decode('utf-8') if data is not None else None
+
+    def list_records(self):
+        for key, mtime in self.client.list('index/'):
+            yield self._entry(key[len('index/'):], mtime, int(mtime * 1e9))
+
+    def has_blob(self, digest):
+        return self.client.exists(self._blob_key(digest))
+
+    def put_blob(self, src_path, digest=None):
+        if digest is None:
+            digest = file_digest(src_path, self.algorithm)
+        if self.has_blob(digest):
+            return digest
+
+        digest, _, spool = _spool(src_path, self.algorithm)
+        with spool:
+            if not self.has_blob(digest):
+                self.client.put(self._blob_key(digest), spool)
+
+        return digest
+
+    def get_blob(self, digest, algorithm=None):
+        data = self.client.get(self._blob_key(digest, algorithm))
+        if data is None:
+            raise IOError('No blob {}'.format(digest))
+
+        return data
+
+    def _blob_key(self, digest, algorithm=None):
+        return 'blobs/{}/{}'.format(algorithm or self.algorithm, digest)
+
+    def _commit(self, hash_code):
+        data = self.client.get('index/' + hash_code)
+        return json.loads(data.decode('utf-8')) if data is not None else None
@@ -0,0 +1,246 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+from lite_tracer.backends import open_storage
+from lite_tracer.index import SearchIndex
+from lite_tracer.query import NEVER, NUMERIC, PRESENT
+from lite_tracer.records import SETTINGS_FILE, Record
+
+# numpy takes longer to import than smaller histories take to search
+VECTORIZE_MIN_RECORDS = 4096
+
+
+def to_float(value):
+    """float of a stored value, nan when it is not numeric"""
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def load_numpy():
+    """numpy if it is installed, None otherwise"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+def load(lt_dir, workers=None, storage='dir'):
+    """ColumnStore of the whole history of lt_dir
+
+    The index is brought up to date first, its records are then streamed
+    into the columns without being kept. storage is the kind of backend the
+    records were written to, see backends.open_storage.
+    """
+    search_index = SearchIndex(lt_dir, workers=workers,
+                               storage=open_storage(lt_dir, storage))
+    try:
+        search_index.update()
+        return ColumnStore(search_index.records())
+    finally:
+        search_index.close()
+
+
+class Column(object):
+    """Every stored value of one parameter, one entry per value
+
+    Distinct values are stored once, interned, the entries only hold the row
+    of their record and the code of their value.
+
+    Attributes:
+    rows: Row of the record of each entry, in row order
+    codes: Code of the value of each entry
+    values (list): The distinct values, a code is an index in it
+    numbers: The distinct values as floats, nan when not numeric
+    present: Rows of the records having the parameter
+    """
+    __slots__ = ('rows', 'codes', 'values', 'numbers', 'present', '_codes_of',
+                 '_np')
+
+    def __init__(self):
+        self.rows = array('i')
+        self.codes = array('i')
+        self.values = list()
+        self.numbers = array('d')
+        self.present = array('i')
+        self._codes_of = dict()
+        self._np = None
+
+    def add(self, row, stored_values):
+        self.present.append(row)
+        for value in stored_values:
+            code = self._codes_of.get(value)
+            if code is None:
+                code = self._codes_of[value] = len(self.values)
+                self.values.append(sys.intern(value))
+                self.numbers.append(to_float(value))
+            self.rows.append(row)
+            self.codes.append(code)
+
+    def freeze(self, np=None):
+        """Ends the adds, moving the arrays to numpy without copying them"""
+        # Rebuilt by the first exact match, it is as large as the values
+        self._codes_of = None
+        if np is None:
+            return
+
+        self._np = np
+        self.rows = np.frombuffer(self.rows, dtype=np.int32)
+        self.codes = np.frombuffer(self.codes, dtype=np.int32)
+        self.numbers = np.frombuffer(self.numbers, dtype=np.float64)
+        self.present = np.frombuffer(self.present, dtype=np.int32)
+
+    def stored_values(self, row):
+        """Values of the record at row, None when it lacks the parameter"""
+        i = bisect_left(self.present, row)
+        if i == len(self.present) or self.present[i] != row:
+            return None
+
+        start = bisect_left(self.rows, row)
+        end = bisect_right(self.rows, row, start)
+        return [self.values[c] for c in self.codes[start:end]]
+
+    def match(self, pattern):
+        """Rows having a value that matches a compiled Pattern
+
+        The pattern is evaluated once per distinct value, the entries are
+        then selected by the code of their value.
+        """
+        if pattern.kind == PRESENT:
+            return self.present
+        if pattern.kind == NEVER:
+            return self.present[:0]
+
+        np = self._np
+        if pattern.kind == NUMERIC:
+            compare = pattern.compare
+            value = pattern.value
+            if np is not None:
+                return self.rows[compare(value, self.numbers)[self.codes]]
+            hits = [compare(value, n) for n in self.numbers]
+            return [r for r, c in zip(self.rows, self.codes) if hits[c]]
+
+        if self._codes_of is None:
+            self._codes_of = dict((v, c) for c, v in enumerate(self.values))
+        code = self._codes_of.get(pattern.value)
+        if code is None:
+            return self.present[:0]
+        if np is not None:
+            return self.rows[self.codes == code]
+        return [r for r, c in zip(self.rows, self.codes) if c == code]
+
+
+class ColumnStore(object):
+    """Search history held as one typed column per parameter
+
+    Records are added to the columns as they are read and not kept, so a
+    whole history fits in memory, e.g. ColumnStore(search_index.records()).
+    Patterns are evaluated against a whole column at once and combined as row
+    masks, so a query costs a few array operations rather than a Python loop
+    over every stored value of every record. Vectorized with numpy when it is
+    installed and the history is large enough, array and set based otherwise.
+
+    Attributes:
+    hash_strs (list): Hash code of the record at each row
+    ctimes (array): ctime of the record at each row
+    """
+    def __init__(self, records):
+        self.hash_strs = list()
+        self.ctimes = array('d')
+        self._sources = list()
+        self._columns = dict()
+        self._np = None
+
+        sources = dict()
+        for row, record in enumerate(records):
+            self.hash_strs.append(record.hash_str)
+            self.ctimes.append(record.ctime)
+            # The directory holding the record dir and the backend it is
+            # read through, shared by most records
+            source = (os.path.dirname(os.path.dirname(record.settings_path)),
+                      record.storage)
+            self._sources.append(sources.setdefault(source, source))
+
+            for key, stored_values in record.kwargs.items():
+                column = self._columns.get(key)
+                if column is None:
+                    column = self._columns[sys.intern(key)] = Column()
+                column.add(row, stored_values)
+
+        if len(self) >= VECTORIZE_MIN_RECORDS:
+            self._np = load_numpy()
+        for column in self._columns.values():
+            column.freeze(self._np)
+
+    def __len__(self):
+        return len(self.hash_strs)
+
+    def column(self, key):
+        """Column of a parameter, empty if no record has it"""
+        column = self._columns.get(key)
+        if column is None:
+            column = Column()
+            column.freeze(self._np)
+
+        return column
+
+    def record(self, row):
+        """Rebuilds the Record at row"""
+        hash_str = self.hash_strs[row]
+        kwargs = dict()
+        for key, column in self._columns.items():
+            stored_values = column.stored_values(row)
+            if stored_values is not None:
+                kwargs[key] = stored_values
+
+        parent, storage = self._sources[row]
+        settings_path = os.path.join(parent, hash_str,
+                                     SETTINGS_FILE.format(hash_str))
+        return Record(hash_str, self.ctimes[row], settings_path, kwargs, storage)
+
+    def select(self, query):
+        """Rows of the records matching a Query, in order"""
+        np = self._np
+        if np is not None:
+            selected = np.ones(len(self), dtype=bool)
+        else:
+            selected = set(range(len(self)))
+
+        for key, patterns in query.include.keys:
+            column = self.column(key)
+            if not len(column.present):
+                return list()
+            for pattern in patterns:
+                selected &= self._mask(column.match(pattern))
+
+        for key, patterns in query.exclude.keys:
+            column = self.column(key)
+            for pattern in patterns:
+                if np is not None:
+                    selected[column.match(pattern)] = False
+                else:
+                    selected.difference_update(column.match(pattern))
+
+        if np is not None:
+            return np.flatnonzero(selected).tolist()
+
+        return sorted(selected)
+
+    def _mask(self, rows):
+        if self._np is None:
+            return set(rows)
+
+        mask = self._np.zeros(len(self), dtype=bool)
+        mask[rows] = True
+        return mask
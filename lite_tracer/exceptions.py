@@ -14,6 +14,14 @@ class GitError(RuntimeError):
         self.errors = errors
 
 
+class NoRecordError(RuntimeError):
+    """There is no record with the given hash code"""
+
+
+class RecordWriteError(RuntimeError):
+    """The record could not be written as it was hashed"""
+
+
 class NoMatchError(RuntimeError):
     """There are no match for the given parameters"""
 
@@ -0,0 +1,161 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 1 << 20
+DEFAULT_ALGORITHM = 'md5'
+# An mtime this recent may still change within the same tick, so an
+# unchanged stat does not prove the file is unchanged
+RACY_SECONDS = 2.0
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM, data=b''):
+    """hashlib object for any algorithm hashlib provides, e.g. blake2b"""
+    try:
+        return hashlib.new(algorithm, data)
+    except (ValueError, TypeError):
+        raise ValueError('hash_algorithm needs to be one of [{}]'.format(
+            '/'.join(sorted(hashlib.algorithms_available))))
+
+
+def check_algorithm(algorithm):
+    new_hash(algorithm)
+    if algorithm.startswith('shake_'):
+        raise ValueError('{} has no fixed digest size'.format(algorithm))
+
+    return algorithm
+
+
+def file_digest(path, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE):
+    digest = new_hash(algorithm)
+    with open(path, 'rb') as file_handler:
+        for chunk in iter(lambda: file_handler.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def digest_files(paths, algorithm=DEFAULT_ALGORITHM, hash_cache=None,
+                 workers=None):
+    """Hashes files in parallel, returns {path: digest}
+
+    hashlib releases the GIL while hashing large chunks, so a thread per core
+    is enough to hash at disk speed.
+    """
+    paths = sorted(paths)
+    if hash_cache is not None:
+        digest = hash_cache.digest
+    else:
+        def digest(path):
+            return file_digest(path, algorithm)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if len(paths) < 2 or workers < 2:
+        return dict((path, digest(path)) for path in paths)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return dict(zip(paths, pool.map(digest, paths)))
+
+
+class HashCache(object):
+    """Persistent file digest cache keyed by (path, size, mtime_ns, inode)
+
+    Files whose stat did not change since they were hashed are not read again.
+    The cache file is replaced atomically and merged with the entries other
+    runs saved in the meantime, so it is safe to share between runs.
+
+    Attributes:
+    cache_path (str): JSON file holding the cache
+    algorithm (str): Hash algorithm of the cached digests
+    """
+    _VERSION = 1
+
+    def __init__(self, cache_path, algorithm=DEFAULT_ALGORITHM):
+        self.cache_path = cache_path
+        self.algorithm = algorithm
+        self._entries = self._load()
+        self._updated = dict()
+        self._evicted = set()
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        key = os.path.abspath(path)
+        file_stat = os.stat(path)
+        stamp = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[:3] == stamp:
+            return entry[3]
+
+        digest = file_digest(path, self.algorithm)
+        with self._lock:
+            # Racy files are hashed but not cached
+            if time.time() - file_stat.st_mtime > RACY_SECONDS:
+                self._entries[key] = self._updated[key] = stamp + [digest]
+            elif entry is not None:
+                self._evict(key)
+
+        return digest
+
+    def evict_stale(self):
+        """Drops the entries of files that changed or no longer exist"""
+        for key, entry in list(self._entries.items()):
+            try:
+                file_stat = os.stat(key)
+            except OSError:
+                self._evict(key)
+                continue
+
+            stamp = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+            if entry[:3] != stamp:
+                self._evict(key)
+
+    def save(self):
+        if not self._updated and not self._evicted:
+            return
+
+        entries = self._load()
+        for key in self._evicted:
+            entries.pop(key, None)
+        entries.update(self._updated)
+
+        # store imports this module
+        from lite_tracer.store import atomic_write
+        with atomic_write(self.cache_path, 'w') as tmp_file:
+            json.dump({'version': self._VERSION,
+                       'algorithm': self.algorithm,
+                       'entries': entries}, tmp_file)
+
+        self._entries = entries
+        self._updated = dict()
+        self._evicted = set()
+
+    def _evict(self, key):
+        self._entries.pop(key, None)
+        self._updated.pop(key, None)
+        self._evicted.add(key)
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                content = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+        if not isinstance(content, dict) or content.get('version') != self._VERSION:
+            return dict()
+        if content.get('algorithm') != self.algorithm:
+            return dict()
+
+        return content.get('entries', dict())
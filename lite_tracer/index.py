@@ -0,0 +1,368 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import heapq
+import json
+import operator
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join as pjoin
+
+import lite_tracer.store as store
+from lite_tracer.backends import LocalBackend, open_storage
+from lite_tracer.query import NUMERIC, PRESENT, STRING, Query, get_param_operator_value
+from lite_tracer.records import Record
+
+# The index and its journal live in a dir of their own, writing them must
+# not change the mtime of lt_dir its stamp is made of
+INDEX_DIR = '.lt_index'
+INDEX_FILE = 'index.sqlite'
+CHUNK_FILES = 256
+CHUNK_IDS = 500
+# Patterns compare query OP stored, the index compares stored OP query
+_SQL_OPS = {operator.eq: '=', operator.le: '>=', operator.ge: '<=',
+            operator.lt: '>', operator.gt: '<'}
+
+
+def parse_chunk(entries):
+    """Index rows of RecordEntries, run in the worker processes"""
+    rows = list()
+    for entry in entries:
+        try:
+            parsed = entry.parse()
+        except (IOError, OSError):
+            continue
+        rows.append((entry.settings_path, parsed.hash_str, parsed.ctime,
+                     entry.mtime_ns, parsed.kwargs))
+
+    return rows
+
+
+def param_rows(record_id, kwargs):
+    """params rows of a record, a NULL value row marks each key present"""
+    rows = list()
+    for key, values in kwargs.items():
+        rows.append((record_id, key, None, None))
+        rows.extend((record_id, key, v, _number(v)) for v in set(values))
+
+    return rows
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+
+    return number if number == number else None
+
+
+def search(lt_dir, include=None, exclude=None, since=None, until=None,
+           reverse=False, limit=None, workers=None, storage='dir'):
+    """Yields the Records of lt_dir matching include and exclude by ctime
+
+    include and exclude are lists of lite_trace.py patterns, e.g.
+    ['lr>=0.01', 'optimizer:sgd'] for lr at most 0.01, comparisons read
+    value OP param. storage is the kind of backend the records
+    were written to, see backends.open_storage. The index is brought up to
+    date first, keep a SearchIndex open to run many searches.
+    """
+    search_index = SearchIndex(lt_dir, workers=workers,
+                               storage=open_storage(lt_dir, storage))
+    try:
+        search_index.update(since=since)
+        for record in search_index.search(include, exclude, since, until,
+                                          reverse, limit):
+            yield record
+    finally:
+        search_index.close()
+
+
+def _chunks(items, size=CHUNK_IDS):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _ctime_range(since, until):
+    """sql condition and arguments of a ctime range"""
+    where = ['1']
+    args = list()
+    if since is not None:
+        where.append('ctime >= ?')
+        args.append(since)
+    if until is not None:
+        where.append('ctime <= ?')
+        args.append(until)
+
+    return ' AND '.join(where), args
+
+
+class SearchIndex(object):
+    """On-disk sqlite index of the parsed settings files of a record dir
+
+    update only re-parses settings files that are new or changed since the
+    last scan, and skips the scan altogether when the stamp of the storage,
+    e.g. the mtimes of lt_dir and its generation file, did not change.
+
+    Every parameter value is also indexed by (key, value) and by (key,
+    number), so select answers a query from posting lists of the matching
+    records only. The records having each distinct list of values of a
+    parameter are counted as they are indexed, for non_defaults.
+
+    Attributes:
+    lt_dir (str): Folder containing the LT records
+    index_path (str): sqlite file, in memory if lt_dir is missing or not
+        writable
+    workers (int): Processes parsing a large scan, one per core by default
+    storage: Backend the records are listed and read through, lt_dir itself
+    by default
+    """
+    _SCHEMA_VERSION = '3'
+    # Fewer changed files than this are parsed in process
+    _PARALLEL_MIN_FILES = 2048
+
+    def __init__(self, lt_dir, index_path=None, workers=None, storage=None):
+        self.lt_dir = lt_dir
+        self.index_path = index_path or pjoin(lt_dir, INDEX_DIR, INDEX_FILE)
+        self.workers = workers or os.cpu_count() or 1
+        self.storage = storage or LocalBackend(lt_dir)
+
+        if index_path is None and not os.path.isdir(lt_dir):
+            # Searching a missing lt_dir must not create it
+            self.index_path = ':memory:'
+
+        try:
+            store.makedirs(os.path.dirname(self.index_path) or '.')
+            self._db = sqlite3.connect(self.index_path, timeout=30)
+            self._create_tables()
+        except (OSError, sqlite3.Error):
+            self.index_path = ':memory:'
+            self._db = sqlite3.connect(self.index_path)
+            self._create_tables()
+
+    def close(self):
+        self._db.close()
+
+    def update(self, progress=None, since=None):
+        """Parses new and changed records, returns how many were parsed
+
+        progress, if given, is called with (parsed, total) as chunks of
+        records are parsed. Records whose settings file is older than since
+        are left for a later update without being opened.
+        """
+        stamp = self.storage.stamp()
+        if stamp is not None and stamp == self._get_meta('stamp'):
+            return 0
+
+        known = dict(self._db.execute('SELECT file_path, mtime_ns FROM records'))
+        changed = list()
+        seen = set()
+        for entry in self.storage.list_records():
+            seen.add(entry.settings_path)
+            if known.get(entry.settings_path) == entry.mtime_ns:
+                continue
+            if since is not None and entry.ctime < since:
+                stamp = None
+                continue
+            changed.append(entry)
+
+        changed.sort(key=lambda entry: entry.settings_path)
+        rows = list()
+        for chunk_rows in self._parse(changed, progress):
+            rows.extend(chunk_rows)
+
+        stale = [(f,) for f in set(known) - seen] + [row[:1] for row in rows]
+        with self._db:
+            for file_path, in stale:
+                for kwargs, in self._db.execute(
+                        'SELECT kwargs FROM records WHERE file_path = ?', (file_path,)):
+                    self._count_values(json.loads(kwargs), -1)
+            self._db.executemany(
+                'DELETE FROM params WHERE record_id IN '
+                '(SELECT id FROM records WHERE file_path = ?)', stale)
+            self._db.executemany('DELETE FROM records WHERE file_path = ?', stale)
+            for file_path, hash_str, ctime, mtime_ns, kwargs in rows:
+                cursor = self._db.execute(
+                    'INSERT INTO records '
+                    '(file_path, hash_str, ctime, mtime_ns, kwargs) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (file_path, hash_str, ctime, mtime_ns, json.dumps(kwargs)))
+                self._db.executemany('INSERT INTO params VALUES (?, ?, ?, ?)',
+                                     param_rows(cursor.lastrowid, kwargs))
+                self._count_values(kwargs, 1)
+            self._db.execute('DELETE FROM value_counts WHERE records <= 0')
+            self._set_meta('stamp', stamp)
+
+        return len(rows)
+
+    def empty(self):
+        return self._db.execute('SELECT 1 FROM records LIMIT 1').fetchone() is None
+
+    def non_defaults(self):
+        """Parameters that do not have the same values in every record"""
+        return set(key for key, in self._db.execute(
+            'SELECT key FROM value_counts GROUP BY key HAVING COUNT(*) > 1'))
+
+    def search(self, include=None, exclude=None, since=None, until=None,
+               reverse=False, limit=None):
+        """Yields the matching Records by ctime, see search"""
+        query = Query(get_param_operator_value(include or list()),
+                      get_param_operator_value(exclude or list()))
+        record_ids = self.select(query, since, until)
+        return self.ordered(record_ids, reverse, limit)
+
+    def records(self, record_ids=None):
+        """Yields the indexed records as Records, all of them by default,
+        otherwise in the order of record_ids"""
+        select = 'SELECT id, hash_str, ctime, file_path, kwargs FROM records'
+        if record_ids is None:
+            for row in self._db.execute(select + ' ORDER BY id'):
+                yield Record(*row[1:], storage=self.storage)
+            return
+
+        for chunk in _chunks(list(record_ids)):
+            rows = dict((row[0], row) for row in self._db.execute(
+                '{} WHERE id IN ({})'.format(select, ','.join('?' * len(chunk))),
+                chunk))
+            for record_id in chunk:
+                yield Record(*rows[record_id][1:], storage=self.storage)
+
+    def ordered(self, record_ids, reverse=False, limit=None):
+        """Yields records by ctime, oldest first unless reverse
+
+        Only (ctime, id) pairs are sorted, with a heap of limit pairs when
+        a limit is given, and the records are fetched as they are yielded.
+        """
+        pairs = self._ctimes(record_ids)
+        if limit is None:
+            pairs = sorted(pairs, reverse=reverse)
+        elif reverse:
+            pairs = heapq.nlargest(limit, pairs)
+        else:
+            pairs = heapq.nsmallest(limit, pairs)
+
+        return self.records(record_id for _, record_id in pairs)
+
+    def select(self, query, since=None, until=None):
+        """Sorted ids of the records matching a Query, with a ctime between
+        since and until when given
+
+        Include patterns intersect their posting lists, exclude patterns
+        subtract theirs. Only an empty include reads every record id.
+        """
+        selected = None
+        for key, patterns in query.include.keys:
+            for pattern in patterns:
+                posting = self._posting(key, pattern)
+                selected = posting if selected is None else selected & posting
+                if not selected:
+                    return list()
+
+        where, args = _ctime_range(since, until)
+        if selected is None:
+            selected = set(r for r, in self._db.execute(
+                'SELECT id FROM records WHERE ' + where, args))
+        elif args:
+            selected = set(r for _, r in self._ctimes(selected, since, until))
+
+        for key, patterns in query.exclude.keys:
+            for pattern in patterns:
+                selected -= self._posting(key, pattern)
+
+        return sorted(selected)
+
+    def _count_values(self, kwargs, delta):
+        """Counts the records having each (key, values) of kwargs"""
+        self._db.executemany(
+            'INSERT INTO value_counts VALUES (?, ?, ?) '
+            'ON CONFLICT (key, value_list) DO UPDATE '
+            'SET records = records + excluded.records',
+            [(key, json.dumps(values), delta) for key, values in kwargs.items()])
+
+    def _ctimes(self, record_ids, since=None, until=None):
+        """Yields (ctime, id) of the records in the ctime range"""
+        where, args = _ctime_range(since, until)
+        for chunk in _chunks(list(record_ids)):
+            for row in self._db.execute(
+                    'SELECT ctime, id FROM records WHERE id IN ({}) AND {}'.format(
+                        ','.join('?' * len(chunk)), where), chunk + args):
+                yield row
+
+    def _posting(self, key, pattern):
+        """Ids of the records having a value of key that matches pattern"""
+        if pattern.kind == PRESENT:
+            where, args = 'value IS NULL', (key,)
+        elif pattern.kind == STRING:
+            where, args = 'value = ?', (key, pattern.value)
+        elif pattern.kind == NUMERIC:
+            where = 'number {} ?'.format(_SQL_OPS[pattern.compare])
+            args = (key, pattern.value)
+        else:
+            return set()
+
+        return set(r for r, in self._db.execute(
+            'SELECT record_id FROM params WHERE key = ? AND ' + where, args))
+
+    def _parse(self, changed, progress):
+        """Yields the rows of each chunk of changed files, in order"""
+        chunks = [changed[i:i + CHUNK_FILES]
+                  for i in range(0, len(changed), CHUNK_FILES)]
+
+        if self.workers < 2 or len(changed) < self._PARALLEL_MIN_FILES:
+            chunk_rows = map(parse_chunk, chunks)
+            pool = None
+        else:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+            chunk_rows = pool.map(parse_chunk, chunks)
+
+        try:
+            done = 0
+            for chunk, rows in zip(chunks, chunk_rows):
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, len(changed))
+                yield rows
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _create_tables(self):
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(key TEXT PRIMARY KEY, value TEXT)')
+            if self._get_meta('schema') != self._SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS records')
+                self._db.execute('DROP TABLE IF EXISTS params')
+                self._db.execute('DROP TABLE IF EXISTS value_counts')
+                self._set_meta('stamp', None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS records '
+                             '(id INTEGER PRIMARY KEY, file_path TEXT UNIQUE, '
+                             'hash_str TEXT, ctime REAL, mtime_ns INTEGER, '
+                             'kwargs TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS params '
+                             '(record_id INTEGER, key TEXT, value TEXT, '
+                             'number REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS value_counts '
+                             '(key TEXT, value_list TEXT, records INTEGER, '
+                             'PRIMARY KEY (key, value_list))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS params_value '
+                             'ON params (key, value)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS params_number '
+                             'ON params (key, number)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS params_record '
+                             'ON params (record_id)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS records_ctime '
+                             'ON records (ctime)')
+            self._set_meta('schema', self._SCHEMA_VERSION)
+
+    def _get_meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         (key, value))
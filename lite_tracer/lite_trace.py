@@ -7,123 +7,170 @@
 
 from __future__ import print_function
 import sys
-import glob
 import os
 import argparse
 import time
-import re
 
-from collections import defaultdict
+from datetime import datetime
 
 import lite_tracer.exceptions as exception
+import lite_tracer.packs as packs
+import lite_tracer.store as store
+from lite_tracer.backends import STORAGE_KINDS, open_storage
+from lite_tracer.index import SearchIndex
+from lite_tracer.restore import restore as restore_record
 
 
-class Parsed(object):
-    def __init__(self, file_path, line):
-        self.line = line
+def main(argv=None):
+    """Runs a command given as the first argument, searches otherwise"""
+    if argv is None:
+        argv = sys.argv[1:]
 
-        self.file_name = file_path
-        self.ctime = os.path.getctime(self.file_name)
-        self.end_str = ".txt"
-        self.start_str = "settings_"
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
 
-        hash_str_regex = re.compile('(?<=settings_)LT.*LT(?=.txt)')
-        self.hash_str = re.search(hash_str_regex, file_path).group(0)
-        self.line = line
+    return search(argv)
 
-        tmp = [self._param_extraction(x)
-               for x in self._param_split(self.line)]
-        self.kwargs = dict([tuple(kv) for kv in tmp])
 
-    def _param_extraction(self, split_param_str):
-        split_param_str = self._clean_params(split_param_str)
-        split = split_param_str.split(' ')
-        key = split[0].replace('--', '')
-        values = split[1:]
+def search(argv):
+    parser = argparse.ArgumentParser(
+        description="explore saved experiment results by matching hyperparameter flags")
 
-        return key, values
+    parser.add_argument('-d', '--lt_dir', type=str,
+                        default='./lt_records', help="folder containing LT records")
+    parser.add_argument('-s', '--storage', choices=STORAGE_KINDS, default='dir',
+                        help="backend the records were written to")
 
-    # Needed for backward compatibility, fixed version does not need it
-    # May cause problems with adding text notes
-    def _clean_params(self, params):
-        bad_chars = '[],\''
-        for char in bad_chars:
-            params = params.replace(char, '')
+    parser.add_argument('-i', '--include', type=str, nargs='+')
+    parser.add_argument('-e', '--exclude', type=str, nargs='+')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="processes parsing new records, one per core by default")
+    parser.add_argument('-n', '--limit', type=int, default=None,
+                        help="print at most this many results")
+    parser.add_argument('-r', '--reverse', action='store_true',
+                        help="newest results first")
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help="only records created from this date, e.g. 2018-06-30")
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help="only records created up to this date")
+
+    args = parser.parse_args(argv)
+
+    lt_dir = os.path.expanduser(args.lt_dir)
+    if not os.path.isdir(lt_dir):
+        raise exception.NoHistory()
 
-        return params
+    search_index = SearchIndex(lt_dir, workers=args.workers,
+                               storage=open_storage(lt_dir, args.storage))
+    search_index.update(progress=print_progress if sys.stderr.isatty() else None,
+                        since=args.since)
 
-    def _param_split(self, raw_param_str):
-        param_split = re.compile('[-]{1,2}[a-zA-Z].*?(?= [-]{1,2}[a-zA-Z]|$)')
-        split_param_strs = re.findall(param_split, raw_param_str)
-        return split_param_strs
+    if search_index.empty():
+        raise exception.NoHistory()
 
+    non_defaults = search_index.non_defaults()
+    results = search_index.search(args.include, args.exclude, args.since,
+                                  args.until, args.reverse, args.limit)
+    found = False
+    for result in results:
+        print(format_output(result, non_defaults))
+        sys.stdout.flush()
+        found = True
 
-class FindDefault(object):
-    def __init__(self):
-        self.non_defaults = set()
-        self.values = dict()
+    if not found:
+        raise exception.NoMatchError()
 
-    def add(self, params):
-        changed = [k for k, v in params.items()
-                   if self.values.setdefault(k, v) != v]
 
-        if changed:
-            self.non_defaults |= set(changed)
+def reshard(argv):
+    parser = argparse.ArgumentParser(
+        prog='lite_trace.py reshard',
+        description="move the records to lt_dir/<shard>/<hash_code>, in place")
 
+    parser.add_argument('-d', '--lt_dir', type=str,
+                        default='./lt_records', help="folder containing LT records")
+    parser.add_argument('--flat', action='store_true',
+                        help="move the records back to lt_dir/<hash_code>")
+
+    args = parser.parse_args(argv)
+
+    lt_dir = os.path.expanduser(args.lt_dir)
+    if not os.path.isdir(lt_dir):
+        raise exception.NoHistory()
 
-def main():
+    moved = store.reshard(lt_dir, sharded=not args.flat)
+    print("moved {} records".format(moved))
+
+
+def pack(argv):
     parser = argparse.ArgumentParser(
-        description="explore saved experiment results by matching hyperparameter flags")
+        prog='lite_trace.py pack',
+        description="move old records into a pack file, they stay searchable")
 
     parser.add_argument('-d', '--lt_dir', type=str,
                         default='./lt_records', help="folder containing LT records")
+    parser.add_argument('--days', type=float, required=True,
+                        help="pack the records created more than this many days ago")
 
-    parser.add_argument('-i', '--include', type=str, nargs='+')
-    parser.add_argument('-e', '--exclude', type=str, nargs='+')
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    lt_dir = os.path.expanduser(args.lt_dir)
+    if not os.path.isdir(lt_dir):
+        raise exception.NoHistory()
 
-    setting_files_regex_path = os.path.expanduser(os.path.join(args.lt_dir, "LT*LT/settings*.txt"))
-    setting_file_list = [f for f in glob.glob(setting_files_regex_path)
-                         if 'searchable' not in f]
+    packed, pack_path = packs.pack_records(lt_dir, args.days)
+    if pack_path is None:
+        print("no records older than {} days".format(args.days))
+    else:
+        print("packed {} records into {}".format(packed, pack_path))
 
-    if not setting_file_list:
-        raise exception.NoHistory()
 
-    include_params = get_param_operator_value(args.include) if args.include else defaultdict(list)
-    exclude_params = get_param_operator_value(args.exclude) if args.exclude else defaultdict(list)
+def restore(argv):
+    parser = argparse.ArgumentParser(
+        prog='lite_trace.py restore',
+        description="rebuild the code state a record was made from")
 
-    if include_params is None and exclude_params is None:
-        raise exception.NoParameterError()
+    parser.add_argument('hash_code', type=str)
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="missing or empty folder, "
+                             "lt_dir/restored/<hash_code> by default")
+    parser.add_argument('-d', '--lt_dir', type=str,
+                        default='./lt_records', help="folder containing LT records")
+    parser.add_argument('-s', '--storage', choices=STORAGE_KINDS, default='dir',
+                        help="backend the records were written to")
+    parser.add_argument('--repo', type=str, default='.',
+                        help="git repository the records were made in")
+    parser.add_argument('--link', action='store_true',
+                        help="hardlink the files instead of copying them, "
+                             "they must then not be edited in place")
 
-    search_results = list()
-    param_default_checker = FindDefault()
+    args = parser.parse_args(argv)
 
-    for file_path in setting_file_list:
-        with open(file_path, 'r') as setting_file:
-            line = setting_file.readline()
+    lt_dir = os.path.expanduser(args.lt_dir)
+    storage = open_storage(lt_dir, args.storage)
+    if not storage.has_record(args.hash_code):
+        raise exception.NoRecordError(args.hash_code)
 
-            parsed = Parsed(file_path, line)
-            parsed_params = parsed.kwargs
-            param_default_checker.add(parsed_params)
+    output = restore_record(args.hash_code, args.output, lt_dir, storage,
+                            args.repo, link=args.link)
+    print(output)
 
-            include_search_result = compare_match(parsed_params, include_params)
-            include_found = all(include_search_result) and len(include_search_result) > 0
 
-            exclude_search_result = compare_match(parsed_params, exclude_params, partial=True)
-            exclude_found = any(exclude_search_result)
+COMMANDS = {'reshard': reshard, 'pack': pack, 'restore': restore}
 
-            # Include results when parameters are not part of the exclusion list AND
-            # parameters in -i option is found OR -i option is not set
-            if not exclude_found and (include_found or not include_params):
-                search_results.append(parsed)
 
-    if not search_results:
-        raise exception.NoMatchError()
+def parse_time(value):
+    """Timestamp of an ISO date or datetime, in local time"""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a date'.format(value))
+
 
-    search_results.sort(key=lambda x: x.ctime)
-    for result in search_results:
-        print(format_output(result, param_default_checker.non_defaults))
+def print_progress(done, total):
+    sys.stderr.write('\rindexing records {}/{}'.format(done, total))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
 
 
 def format_output(result, non_defaults):
@@ -140,100 +187,17 @@ def format_output(result, non_defaults):
     return output_format.format(result.hash_str, ctime, key_value_str)
 
 
-def get_param_operator_value(input_param_values):
-    """Returns dictionary{param:[(operator, value), ...], ...}"""
-    param_operator_value = defaultdict(list)
-    split_regex = re.compile(r'(^[a-zA-Z]{1}[\w-]*)(<=|>=|==|<|>|:)?(.*)?')
-
-    for p_v in input_param_values:
-        p_v_matches = re.match(split_regex, p_v)
-        if p_v_matches is None:
-            raise exception.ArgumentNotParsable()
-
-        par_op_val = [m for m in p_v_matches.groups() if m]
-
-        param = par_op_val[0]
-        if len(par_op_val) == 3:
-            operator_value = (par_op_val[1], par_op_val[2])
-        elif len(par_op_val) == 1:
-            operator_value = ('', '')
-        else:
-            raise exception.ArgumentNotParsable()
-
-        param_operator_value[param].append(operator_value)
-
-    return param_operator_value
-
-
-def compare_match(stored_params, search_params, partial=False):
-    """Compares stored_param against search_params"""
-    stored_keys = set(stored_params.keys())
-    search_keys = set(search_params.keys())
-    possible_search_keys = search_keys.intersection(stored_keys)
-    results_list = list()
-
-    if not partial and possible_search_keys != search_keys:
-        return results_list
-
-    for search_key in possible_search_keys:
-        search_pattern = search_params[search_key]
-        stored_values = stored_params[search_key]
-        matches = (get_match_results(stored_values, pattern)
-                   for pattern in search_pattern)
-        if not partial:
-            results_list.append(all(matches))
-        else:
-            results_list.append(any(matches))
-
-    return results_list
-
-
-def get_match_results(stored_values, pattern):
-    """ Return if any of the the stored params is matching the key """
-    operator = pattern[0]
-    raw_value = pattern[1]
-    numeric = is_numeric(raw_value)
-    cast = float if numeric else str
-
-    value = cast(raw_value)
-
-    if raw_value and not numeric:
-        if operator == ':' or operator == '==':
-            return any(value == v for v in stored_values)
-        else:
-            return False
-
-    casted_values = (cast(v) for v in stored_values
-                     if is_numeric(v))
-
-    if operator == ':' or operator == '==':
-        return any(value == v for v in casted_values)
-    elif operator == '<=':
-        return any(value <= v for v in casted_values)
-    elif operator == '>=':
-        return any(value >= v for v in casted_values)
-    elif operator == '<':
-        return any(value < v for v in casted_values)
-    elif operator == '>':
-        return any(value > v for v in casted_values)
-    else:
-        return True
-
-
-def is_numeric(value):
-    try:
-        float(value)
-        return True
-    except ValueError:
-        return False
-
-
 if __name__ == '__main__':
     try:
         main()
-    except (exception.NoHistory, exception.NoMatchError, exception.NoParameterError) as e:
+    except (exception.NoHistory, exception.NoMatchError, exception.NoParameterError,
+            exception.NoRecordError, exception.GitError) as e:
         if isinstance(e, exception.NoHistory):
             print("Error: There are no previous runs of this experiment")
+        elif isinstance(e, exception.NoRecordError):
+            print("Error: There is no record {}".format(e))
+        elif isinstance(e, exception.GitError):
+            print("Error: {}".format(e.args[0] or e.message))
         elif isinstance(e, exception.NoParameterError):
             print("Error: Parameters were not provided properly")
         elif isinstance(e, exception.NoMatchError):
@@ -0,0 +1,204 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import time
+import uuid
+import warnings
+import zlib
+from os.path import join as pjoin
+
+import lite_tracer.store as store
+from lite_tracer.records import scan_records
+
+PACKS_DIR = 'packs'
+PACK_HEADER = b'LTPACK1\n'
+_DAY_SECONDS = 24 * 60 * 60
+
+
+class Pack(object):
+    """A pack file of records and its offset index
+
+    pack-<id>.pack holds one zlib compressed entry per record: a JSON header
+    line naming its files, then their bytes. pack-<id>.idx maps each hash
+    code to the offset and length of its entry and is written last, a pack
+    without its idx does not exist yet. Packs are never changed once written.
+
+    Attributes:
+    pack_path (str): The .pack file
+    entries (dict): {hash_code: [offset, length, ctime, mtime_ns]}
+    """
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        with open(os.path.splitext(pack_path)[0] + '.idx', 'r') as idx_file:
+            self.entries = json.load(idx_file)['records']
+
+    def read(self, hash_code):
+        """{name: bytes} of the files of a packed record"""
+        offset, length = self.entries[hash_code][:2]
+        with open(self.pack_path, 'rb') as pack_file:
+            pack_file.seek(offset)
+            entry = zlib.decompress(pack_file.read(length))
+
+        header, data = entry.split(b'\n', 1)
+        files = dict()
+        start = 0
+        for name, size in json.loads(header.decode('utf-8'))['files']:
+            files[name] = data[start:start + size]
+            start += size
+
+        return files
+
+
+def load_packs(lt_dir):
+    """Packs of lt_dir, newest first"""
+    packs_dir = pjoin(lt_dir, PACKS_DIR)
+    try:
+        names = os.listdir(packs_dir)
+    except OSError:
+        return list()
+
+    idx_paths = [pjoin(packs_dir, n) for n in names if n.endswith('.idx')]
+    packs = list()
+    for idx_path in sorted(idx_paths, key=os.path.getmtime, reverse=True):
+        packs.append(Pack(os.path.splitext(idx_path)[0] + '.pack'))
+
+    return packs
+
+
+def read_file(files, name):
+    """A file of a packed record as text, like store.read_record_file"""
+    if name in files:
+        return files[name].decode('utf-8')
+
+    for record_format in sorted(store.ARCHIVE_FORMATS):
+        archive = files.get(store.ARCHIVE_FILE.format(record_format))
+        if archive is None:
+            continue
+
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r:*') as tar:
+            try:
+                member = tar.extractfile(name)
+            except KeyError:
+                continue
+            return member.read().decode('utf-8')
+
+    return None
+
+
+def lock_path(lt_dir):
+    """Lock held while packing, and by writers overwriting a record"""
+    return pjoin(lt_dir, PACKS_DIR, '.lock')
+
+
+def pack_records(lt_dir, days, now=None):
+    """Moves the loose records of lt_dir older than days into a new pack,
+    returns (number of records, pack path)
+
+    The pack and its idx are written before any record is removed. Each
+    record dir is then renamed aside and only deleted if its settings did
+    not change since it was packed, a record rewritten meanwhile stays
+    loose and loose records win over packed ones. Records that cannot be
+    read are left loose with a warning. Packing runs are serialized by a
+    lock, writers only wait on it to overwrite a record.
+    """
+    if now is None:
+        now = time.time()
+    packs_dir = pjoin(lt_dir, PACKS_DIR)
+    store.makedirs(packs_dir)
+
+    with store.FileLock(lock_path(lt_dir)):
+        entries = [e for e in scan_records(lt_dir)
+                   if e.ctime < now - days * _DAY_SECONDS]
+        if not entries:
+            return 0, None
+
+        name = 'pack-{}'.format(uuid.uuid4().hex)
+        pack_path = pjoin(packs_dir, name + '.pack')
+        packed = dict()
+        skipped = list()
+        with store.atomic_write(pack_path, sync=True) as pack_file:
+            pack_file.write(PACK_HEADER)
+            for entry in sorted(entries, key=lambda e: e.hash_str):
+                record_path = os.path.dirname(entry.settings_path)
+                try:
+                    data = _entry_bytes(record_path)
+                except (IOError, OSError):
+                    # Removed or rewritten meanwhile, it stays loose
+                    skipped.append(entry.hash_str)
+                    continue
+                packed[entry.hash_str] = [pack_file.tell(), len(data),
+                                          entry.ctime, entry.mtime_ns]
+                pack_file.write(data)
+
+        _write_idx(os.path.splitext(pack_path)[0] + '.idx', packed)
+
+        for entry in entries:
+            if entry.hash_str in packed:
+                _remove_packed(lt_dir, entry)
+
+    store.bump_generation(lt_dir)
+    if skipped:
+        warnings.warn('{} records could not be read and were not packed: {}'
+                      .format(len(skipped), ', '.join(skipped)))
+
+    return len(packed), pack_path
+
+
+def _entry_bytes(record_path):
+    """The entry of a record dir, files of its subdirs such as the untracked/
+    dir of older records are named by their path, e.g. untracked/data.txt"""
+    names = list()
+    for dir_path, dir_names, file_names in os.walk(record_path):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, record_path)
+        for file_name in sorted(file_names):
+            if rel_dir != os.curdir:
+                file_name = pjoin(rel_dir, file_name).replace(os.sep, '/')
+            names.append(file_name)
+
+    contents = list()
+    for name in names:
+        with open(pjoin(record_path, name), 'rb') as record_file:
+            contents.append(record_file.read())
+
+    header = json.dumps({'files': [[n, len(c)] for n, c in zip(names, contents)]})
+    return zlib.compress(header.encode('utf-8') + b'\n' + b''.join(contents))
+
+
+def _write_idx(idx_path, packed):
+    with store.atomic_write(idx_path, 'w', sync=True) as idx_file:
+        json.dump({'version': 1, 'records': packed}, idx_file)
+
+
+def _remove_packed(lt_dir, entry):
+    """Removes a packed record dir unless it was rewritten since"""
+    record_path = os.path.dirname(entry.settings_path)
+    aside_path = pjoin(lt_dir, '.tmp-packed-{}'.format(uuid.uuid4().hex))
+    try:
+        os.rename(record_path, aside_path)
+    except OSError:
+        return
+
+    settings_path = pjoin(aside_path, os.path.basename(entry.settings_path))
+    try:
+        unchanged = os.stat(settings_path).st_mtime_ns == entry.mtime_ns
+    except OSError:
+        unchanged = False
+
+    if not unchanged:
+        try:
+            os.rename(aside_path, record_path)
+            return
+        except OSError:
+            # Written again since it was set aside, that copy is newer
+            pass
+
+    shutil.rmtree(aside_path, ignore_errors=True)
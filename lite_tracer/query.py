@@ -0,0 +1,100 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import operator
+import re
+from collections import defaultdict
+
+import lite_tracer.exceptions as exception
+
+COMPARE_OPS = {':': operator.eq, '==': operator.eq,
+               '<=': operator.le, '>=': operator.ge,
+               '<': operator.lt, '>': operator.gt}
+
+# Pattern kinds
+PRESENT = 'present'
+NUMERIC = 'numeric'
+STRING = 'string'
+NEVER = 'never'
+
+_SPLIT_REGEX = re.compile(r'(^[a-zA-Z]{1}[\w-]*)(<=|>=|==|<|>|:)?(.*)?')
+
+
+def get_param_operator_value(input_param_values):
+    """Returns dictionary{param:[(operator, value), ...], ...}"""
+    param_operator_value = defaultdict(list)
+
+    for p_v in input_param_values:
+        p_v_matches = re.match(_SPLIT_REGEX, p_v)
+        if p_v_matches is None:
+            raise exception.ArgumentNotParsable()
+
+        par_op_val = [m for m in p_v_matches.groups() if m]
+
+        param = par_op_val[0]
+        if len(par_op_val) == 3:
+            operator_value = (par_op_val[1], par_op_val[2])
+        elif len(par_op_val) == 1:
+            operator_value = ('', '')
+        else:
+            raise exception.ArgumentNotParsable()
+
+        param_operator_value[param].append(operator_value)
+
+    return param_operator_value
+
+
+class Pattern(object):
+    """An (operator, value) pattern compiled once per query
+
+    The value is cast and the comparison picked up front, the search index
+    turns it into a lookup of its posting lists.
+
+    Attributes:
+    kind (str): PRESENT, NUMERIC, STRING or NEVER
+    value: The value cast to float for NUMERIC patterns
+    compare: Operator applied as compare(value, stored_value)
+    """
+    __slots__ = ('kind', 'value', 'compare')
+
+    def __init__(self, operator_value):
+        op, raw_value = operator_value
+        self.value = raw_value
+        self.compare = COMPARE_OPS.get(op)
+
+        if not raw_value:
+            self.kind = PRESENT
+            return
+
+        try:
+            self.value = float(raw_value)
+            self.kind = NUMERIC
+        except ValueError:
+            # Not numeric, only an exact match can succeed
+            self.kind = STRING if self.compare is operator.eq else NEVER
+
+
+class Matcher(object):
+    """Include or exclude parameters compiled into patterns
+
+    Attributes:
+    keys (list): [(key, [Pattern, ...]), ...]
+    """
+    def __init__(self, params):
+        self.keys = [(key, [Pattern(p) for p in patterns])
+                     for key, patterns in params.items()]
+
+
+class Query(object):
+    """Include and exclude parameters compiled into two matchers
+
+    A record matches when it has every include key with all of its patterns
+    matching, and no exclude key with any of its patterns matching.
+    SearchIndex.select answers it.
+    """
+    def __init__(self, include_params=None, exclude_params=None):
+        self.include = Matcher(include_params or dict())
+        self.exclude = Matcher(exclude_params or dict())
@@ -0,0 +1,234 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import json
+import os
+import re
+import sys
+
+from lite_tracer import store
+
+SETTINGS_PREFIX = 'settings_'
+SETTINGS_FILE = SETTINGS_PREFIX + '{}.txt'
+_UNSET = object()
+
+
+class RecordEntry(object):
+    """A record found by scan_records, nothing of it read yet
+
+    Attributes:
+    hash_str (str): Hash code, the name of the record directory
+    settings_path (str): The settings_<hash_str>.txt file
+    ctime (float): ctime of the settings file
+    mtime_ns (int): mtime of the settings file, or version of the record
+    storage: Backend the record is read through, None for a local directory
+    """
+    __slots__ = ('hash_str', 'settings_path', 'ctime', 'mtime_ns', 'storage')
+
+    def __init__(self, hash_str, settings_path, ctime, mtime_ns, storage=None):
+        self.hash_str = hash_str
+        self.settings_path = settings_path
+        self.ctime = ctime
+        self.mtime_ns = mtime_ns
+        self.storage = storage
+
+    def parse(self):
+        if self.storage is not None:
+            return self.storage.parse_record(self)
+
+        return parse_setting_file(self.settings_path, self.hash_str, self.ctime)
+
+
+def scan_records(lt_dir):
+    """Yields a RecordEntry per record directory of lt_dir as it is listed
+
+    Records of the flat and of the sharded layout are both found, see
+    store.iter_record_dirs. The only syscall per record is the stat of its
+    settings file.
+    """
+    for entry in store.iter_record_dirs(lt_dir):
+        name = entry.name
+        settings_path = os.path.join(entry.path, SETTINGS_FILE.format(name))
+        try:
+            file_stat = os.stat(settings_path)
+        except OSError:
+            continue
+
+        yield RecordEntry(name, settings_path, file_stat.st_ctime,
+                          file_stat.st_mtime_ns)
+
+
+class Record(object):
+    """A search result, its contents are only read when accessed
+
+    Attributes:
+    hash_str (str): Hash code of the record
+    ctime (float): ctime of its settings file
+    settings_path (str): The settings_<hash_str>.txt file
+    record_path (str): Directory of the record
+    kwargs (dict): {param: [str values]}
+    settings (dict): Structured settings, None for older records
+    diff (str): Patch of the uncommitted changes, None without any
+    untracked (dict): {path: digest} of the untracked files
+    storage: Backend the record is read through, None to read its directory
+    """
+    __slots__ = ('hash_str', 'ctime', 'settings_path', 'storage', '_kwargs',
+                 '_settings', '_diff', '_untracked')
+
+    def __init__(self, hash_str, ctime, settings_path, kwargs, storage=None):
+        """kwargs may also be given as its JSON text, decoded on access"""
+        self.hash_str = hash_str
+        self.ctime = ctime
+        self.settings_path = settings_path
+        self.storage = storage
+        self._kwargs = kwargs
+        self._settings = _UNSET
+        self._diff = _UNSET
+        self._untracked = _UNSET
+
+    def __repr__(self):
+        return 'Record({!r})'.format(self.hash_str)
+
+    @property
+    def record_path(self):
+        return os.path.dirname(self.settings_path)
+
+    @property
+    def kwargs(self):
+        if not isinstance(self._kwargs, dict):
+            self._kwargs = json.loads(self._kwargs)
+        return self._kwargs
+
+    @property
+    def settings(self):
+        if self._settings is _UNSET:
+            json_path = os.path.splitext(self.settings_path)[0] + '.json'
+            try:
+                if self.storage is not None:
+                    self._settings = json.loads(self.storage.read_file(
+                        self.hash_str, os.path.basename(json_path)))
+                else:
+                    with open(json_path, 'r') as json_file:
+                        self._settings = json.load(json_file)
+            except (IOError, OSError, TypeError, ValueError):
+                self._settings = None
+        return self._settings
+
+    @property
+    def diff(self):
+        if self._diff is _UNSET:
+            if self.storage is not None:
+                self._diff = self.storage.read_patch(self.hash_str)
+            else:
+                self._diff = store.read_patch(self.record_path)
+        return self._diff
+
+    @property
+    def untracked(self):
+        if self._untracked is _UNSET:
+            if self.storage is not None:
+                text = self.storage.read_file(self.hash_str, store.MANIFEST_FILE)
+                self._untracked = store.parse_manifest(text or '')[0]
+            else:
+                self._untracked = store.read_manifest(self.record_path)[0]
+        return self._untracked
+
+
+def parse_setting_file(file_path, hash_str=None, ctime=None):
+    """Parses the structured settings, or the settings line of old records
+
+    hash_str and ctime are read from file_path when not given.
+    """
+    try:
+        with open(os.path.splitext(file_path)[0] + '.json', 'r') as json_file:
+            settings = json.load(json_file)
+    except (IOError, OSError, ValueError):
+        settings = None
+
+    if settings is not None:
+        return Parsed.from_settings(file_path, settings, hash_str, ctime)
+
+    with open(file_path, 'r') as setting_file:
+        line = setting_file.readline()
+
+    return Parsed(file_path, line, hash_str, ctime)
+
+
+def settings_kwargs(settings):
+    """{param: [str values]} from structured settings, like the legacy parse"""
+    kwargs = dict()
+    for key, param in settings['params'].items():
+        value = param['value']
+        if isinstance(value, list):
+            kwargs[sys.intern(key)] = [str(v) for v in value]
+        else:
+            kwargs[sys.intern(key)] = [str(value)]
+
+    return kwargs
+
+
+class Parsed(object):
+    __slots__ = ('file_name', 'hash_str', 'ctime', 'kwargs')
+
+    def __init__(self, file_path, line, hash_str=None, ctime=None):
+        self.file_name = file_path
+        if ctime is None:
+            ctime = os.path.getctime(self.file_name)
+        self.ctime = ctime
+
+        if hash_str is None:
+            hash_str_regex = re.compile('(?<=settings_)LT.*LT(?=.txt)')
+            hash_str = re.search(hash_str_regex, file_path).group(0)
+        self.hash_str = hash_str
+
+        tmp = [self._param_extraction(x)
+               for x in self._param_split(line)]
+        self.kwargs = dict([tuple(kv) for kv in tmp])
+
+    @classmethod
+    def from_settings(cls, file_path, settings, hash_str=None, ctime=None):
+        """Builds a record from structured settings, no regex involved"""
+        if hash_str is None:
+            file_name = os.path.splitext(os.path.basename(file_path))[0]
+            hash_str = file_name[len(SETTINGS_PREFIX):]
+        if ctime is None:
+            ctime = os.path.getctime(file_path)
+
+        return cls.from_index(file_path, hash_str, ctime,
+                              settings_kwargs(settings))
+
+    @classmethod
+    def from_index(cls, file_path, hash_str, ctime, kwargs):
+        """Rebuilds a record from the search index without parsing it"""
+        parsed = cls.__new__(cls)
+        parsed.file_name = file_path
+        parsed.hash_str = hash_str
+        parsed.ctime = ctime
+        parsed.kwargs = kwargs
+
+        return parsed
+
+    def _param_extraction(self, split_param_str):
+        split_param_str = self._clean_params(split_param_str)
+        split = split_param_str.split(' ')
+        key = sys.intern(split[0].replace('--', ''))
+        values = split[1:]
+
+        return key, values
+
+    # Needed for backward compatibility, fixed version does not need it
+    # May cause problems with adding text notes
+    def _clean_params(self, params):
+        bad_chars = '[],\''
+        for char in bad_chars:
+            params = params.replace(char, '')
+
+        return params
+
+    def _param_split(self, raw_param_str):
+        param_split = re.compile('[-]{1,2}[a-zA-Z].*?(?= [-]{1,2}[a-zA-Z]|$)')
+        split_param_strs = re.findall(param_split, raw_param_str)
+        return split_param_strs
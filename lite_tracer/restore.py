@@ -0,0 +1,186 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import json
+import os
+import shutil
+import subprocess
+import uuid
+from os.path import join as pjoin
+
+import lite_tracer.exceptions as exception
+import lite_tracer.store as store
+from lite_tracer.backends import LocalBackend
+from lite_tracer.records import SETTINGS_FILE, Parsed
+
+WORKTREES_DIR = 'worktrees'
+RESTORED_DIR = 'restored'
+
+
+def restore(hash_code, dst_dir=None, lt_dir='lt_records', storage=None,
+            repo_dir='.', link=False):
+    """Rebuilds the code state a record was made from in dst_dir, returns
+    dst_dir
+
+    The commit of its git_label is checked out once into a git worktree
+    cached under lt_dir/worktrees, whose files are copied into dst_dir. The
+    patch of the record is then applied and its untracked files are copied
+    from the blob store, or from the untracked/ dir of older records.
+
+    With link, files are hardlinked from the worktree and the blob store
+    instead, and share their content with them and with other restores:
+    editing one in place changes them all. git apply replaces the files it
+    patches, and a worktree whose files were edited is reset before it is
+    used again, the blob store is not.
+
+    dst_dir defaults to lt_dir/restored/<hash_code>, which is replaced. Any
+    other dst_dir has to be missing or empty.
+    """
+    storage = storage or LocalBackend(lt_dir)
+    git_label = record_git_label(storage, hash_code)
+    try:
+        commit = _git(['rev-parse', '--verify', '-q', git_label + '^{commit}'],
+                      repo_dir)
+    except exception.GitError:
+        raise exception.GitError(
+            'Commit {} of {} is not in {}'.format(git_label, hash_code, repo_dir))
+    worktree = cached_worktree(lt_dir, commit, repo_dir)
+
+    if dst_dir is None:
+        dst_dir = pjoin(lt_dir, RESTORED_DIR, hash_code)
+        if os.path.exists(dst_dir):
+            shutil.rmtree(dst_dir)
+    elif os.path.exists(dst_dir) and os.listdir(dst_dir):
+        raise ValueError('{} is not empty'.format(dst_dir))
+
+    dst_parent = os.path.dirname(os.path.abspath(dst_dir))
+    store.makedirs(dst_parent)
+    tmp_path = pjoin(dst_parent, '.tmp-{}'.format(uuid.uuid4().hex))
+    try:
+        _link_tree(worktree, tmp_path, link)
+
+        patch = storage.read_patch(hash_code)
+        if patch:
+            _apply_patch(tmp_path, patch)
+
+        manifest_text = storage.read_file(hash_code, store.MANIFEST_FILE)
+        if manifest_text is None:
+            # Only the names of the untracked files were kept, not their dirs
+            storage.copy_legacy_untracked(hash_code, tmp_path)
+        manifest, algorithm = store.parse_manifest(manifest_text or '')
+        for path, digest in manifest.items():
+            if link:
+                storage.link_blob(digest, pjoin(tmp_path, path), algorithm)
+            else:
+                _write_file(pjoin(tmp_path, path),
+                            storage.get_blob(digest, algorithm))
+
+        if os.path.exists(dst_dir):
+            os.rmdir(dst_dir)
+        os.rename(tmp_path, dst_dir)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    return dst_dir
+
+
+def record_git_label(storage, hash_code):
+    """git_label of a record, from its structured settings when it has them"""
+    settings_name = SETTINGS_FILE.format(hash_code)
+    settings = storage.read_file(hash_code,
+                                 os.path.splitext(settings_name)[0] + '.json')
+    if settings is not None:
+        return json.loads(settings)['params']['git_label']['value']
+
+    line = storage.read_file(hash_code, settings_name)
+    if line is None:
+        raise exception.NoRecordError(hash_code)
+
+    parsed = Parsed(settings_name, line.splitlines(True)[0], hash_code, 0)
+    return parsed.kwargs['git_label'][0]
+
+
+def cached_worktree(lt_dir, commit, repo_dir='.'):
+    """Path of the git worktree of commit, added on first use"""
+    worktrees_dir = pjoin(lt_dir, WORKTREES_DIR)
+    worktree = os.path.abspath(pjoin(worktrees_dir, commit))
+    store.makedirs(worktrees_dir)
+
+    with store.FileLock(pjoin(worktrees_dir, '.lock')):
+        head = None
+        if os.path.isfile(pjoin(worktree, '.git')):
+            try:
+                head = _git(['rev-parse', 'HEAD'], worktree)
+            except exception.GitError:
+                pass
+
+        if head != commit:
+            # Missing, or left over by an interrupted add
+            shutil.rmtree(worktree, ignore_errors=True)
+            _git(['worktree', 'prune'], repo_dir)
+            _git(['worktree', 'add', '-q', '--detach', worktree, commit], repo_dir)
+        elif _git(['-c', 'core.trustctime=false', 'status', '--porcelain',
+                   '--untracked-files=no'], worktree):
+            # A restored file linked from it was edited in place
+            _git(['reset', '-q', '--hard'], worktree)
+
+    return worktree
+
+
+def _link_tree(src_dir, dst_dir, link=False):
+    for dir_path, dir_names, file_names in os.walk(src_dir):
+        rel_dir = os.path.relpath(dir_path, src_dir)
+        if rel_dir == '.':
+            file_names = [n for n in file_names if n != '.git']
+            dir_names[:] = [n for n in dir_names if n != '.git']
+        store.makedirs(os.path.normpath(pjoin(dst_dir, rel_dir)))
+
+        for name in dir_names + file_names:
+            src_path = pjoin(dir_path, name)
+            dst_path = os.path.normpath(pjoin(dst_dir, rel_dir, name))
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+                if name in dir_names:
+                    dir_names.remove(name)
+            elif name in file_names:
+                if link:
+                    store.link_or_copy(src_path, dst_path)
+                else:
+                    shutil.copy2(src_path, dst_path)
+
+
+def _write_file(dst_path, data):
+    store.makedirs(os.path.dirname(dst_path))
+    with open(dst_path, 'wb') as dst_file:
+        dst_file.write(data)
+
+
+def _apply_patch(dst_dir, patch):
+    """Applies a git diff to dst_dir, which is not a git repository"""
+    env = dict(os.environ)
+    # dst_dir may be inside a repository, git apply must not look it up
+    env['GIT_CEILING_DIRECTORIES'] = os.path.dirname(os.path.abspath(dst_dir))
+    process = subprocess.Popen(['git', 'apply', '--whitespace=nowarn', '-'],
+                               cwd=dst_dir, env=env, stdin=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    if not patch.endswith('\n'):
+        # Recorded diffs lost their last newline
+        patch += '\n'
+    _, errors = process.communicate(patch.encode('utf-8'))
+    if process.returncode != 0:
+        raise exception.GitError('git apply failed: {}'.format(
+            errors.decode('utf-8', 'replace')))
+
+
+def _git(args, cwd):
+    try:
+        output = subprocess.check_output(['git'] + args, cwd=cwd,
+                                         stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        raise exception.GitError(e.stderr.decode('utf-8', 'replace'))
+
+    return output.decode('utf-8').strip()
@@ -0,0 +1,562 @@
+# Copyright (c) 2018-present, Royal Bank of Canada.
+# All rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.#
+# Author: Yanshuai Cao
+
+import contextlib
+import difflib
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from os.path import join as pjoin
+
+from lite_tracer.hashing import (CHUNK_SIZE, DEFAULT_ALGORITHM,
+                                 file_digest, new_hash)
+
+PATCH_FILE = 'diff.patch'
+DELTA_FILE = 'diff.delta'
+MANIFEST_FILE = 'untracked.manifest'
+# Records made before the blob store keep copies of their untracked files
+LEGACY_UNTRACKED_DIR = 'untracked'
+RECORD_FILES = (PATCH_FILE, DELTA_FILE, MANIFEST_FILE)
+ARCHIVE_FILE = 'record.{}'
+ARCHIVE_FORMATS = {'tar.gz': 'gz', 'tar.xz': 'xz'}
+GENERATION_FILE = '.generation'
+SHARDED_FILE = '.sharded'
+_HEX = frozenset('0123456789abcdef')
+
+
+def makedirs(path):
+    """os.makedirs that is fine with path existing, or being created by a
+    concurrent process"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', link=False, sync=False, dir_path=None):
+    """Yields a temp file in dir_path, the dir of path by default, which
+    becomes path once the block ends, so readers and concurrent writers
+    never see a partial file
+
+    The temp file replaces path, or with link is only linked to it so an
+    existing path wins. sync fsyncs it first. path may be a function of no
+    argument, called once the content is written, e.g. to name a file by its
+    digest. The temp file is removed if the block raises.
+    """
+    if dir_path is None:
+        dir_path = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as tmp_file:
+            yield tmp_file
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+
+        dst_path = path() if callable(path) else path
+        if not link:
+            os.replace(tmp_path, dst_path)
+            return
+        try:
+            os.link(tmp_path, dst_path)
+        except OSError:
+            if not os.path.exists(dst_path):
+                raise
+    finally:
+        _remove_if_exists(tmp_path)
+
+
+class BlobStore(object):
+    """Content addressed store shared by all the records of a record dir
+
+    Every file is stored once under
+    blobs/<algorithm>/<digest[:2]>/<digest[2:]>, records only keep a manifest
+    of path -> digest.
+
+    Attributes:
+    root (str): Directory holding the blobs
+    algorithm (str): Hash algorithm the blobs are keyed by
+    """
+    def __init__(self, root, algorithm=DEFAULT_ALGORITHM):
+        self.root = root
+        self.algorithm = algorithm
+
+    def blob_path(self, digest):
+        return pjoin(self.root, self.algorithm, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def put(self, src_path, digest=None):
+        """Stores src_path if its content is not stored yet, returns digest
+
+        The content is hashed again while it is copied, the returned digest
+        is the one of what was actually stored.
+        """
+        if digest is None:
+            digest = file_digest(src_path, self.algorithm)
+
+        if os.path.exists(self.blob_path(digest)):
+            return digest
+
+        with open(src_path, 'rb') as src:
+            return self._put_stream(src)
+
+    def put_bytes(self, data):
+        digest = new_hash(self.algorithm, data).hexdigest()
+        if os.path.exists(self.blob_path(digest)):
+            return digest
+
+        return self._put_stream(io.BytesIO(data))
+
+    def get_bytes(self, digest):
+        with open(self.blob_path(digest), 'rb') as blob:
+            return blob.read()
+
+    def _put_stream(self, src):
+        if not os.path.exists(self.root):
+            makedirs(self.root)
+
+        copied_hash = new_hash(self.algorithm)
+
+        def blob_path():
+            dst_path = self.blob_path(copied_hash.hexdigest())
+            makedirs(os.path.dirname(dst_path))
+            return dst_path
+
+        # Named by the digest of what was copied, the source may change
+        with atomic_write(blob_path, dir_path=self.root) as tmp_file:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                copied_hash.update(chunk)
+                tmp_file.write(chunk)
+            # Blobs are shared through hardlinks, never modify them in place
+            os.fchmod(tmp_file.fileno(), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        return copied_hash.hexdigest()
+
+    def link(self, digest, dst_path):
+        """Materialises a blob at dst_path, hardlinked when possible"""
+        dst_dir = os.path.dirname(dst_path)
+        if dst_dir:
+            makedirs(dst_dir)
+
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+
+        src_path = self.blob_path(digest)
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            shutil.copyfile(src_path, dst_path)
+
+
+class FileLock(object):
+    """Exclusive lock on a lock file, released when the holder exits or dies
+
+    Without fcntl the lock is a no-op, concurrent writers then only waste
+    work since every write ends with an atomic rename.
+    """
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._lock_file = None
+
+    def __enter__(self):
+        self._lock_file = open(self.lock_path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+
+def make_temp_dir(parent):
+    """Creates a hidden dir next to its final location, for a later rename"""
+    tmp_path = pjoin(parent, '.tmp-{}-{}'.format(os.getpid(), uuid.uuid4().hex))
+    os.makedirs(tmp_path)
+
+    return tmp_path
+
+
+def link_or_copy(src_path, dst_path):
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+
+
+def commit_dir(tmp_path, final_path, lock_path=None):
+    """Renames tmp_path to final_path, returns False if final_path existed
+
+    An existing final_path gets the files of tmp_path one atomic replace at a
+    time, record files it has that tmp_path does not are removed. The
+    replaces are done holding the lock at lock_path when it is given.
+    """
+    if _rename_dir(tmp_path, final_path):
+        return True
+
+    if lock_path is None:
+        _replace_files(tmp_path, final_path)
+        return False
+
+    makedirs(os.path.dirname(lock_path))
+    with FileLock(lock_path):
+        # final_path may have been moved away while the lock was awaited
+        if _rename_dir(tmp_path, final_path):
+            return True
+        _replace_files(tmp_path, final_path)
+
+    return False
+
+
+def _rename_dir(tmp_path, final_path):
+    try:
+        os.rename(tmp_path, final_path)
+        return True
+    except OSError:
+        if not os.path.isdir(final_path):
+            raise
+
+    return False
+
+
+def _replace_files(tmp_path, final_path):
+    names = os.listdir(tmp_path)
+    for name in names:
+        os.replace(pjoin(tmp_path, name), pjoin(final_path, name))
+
+    stale_names = set(RECORD_FILES)
+    stale_names.update(ARCHIVE_FILE.format(f) for f in ARCHIVE_FORMATS)
+    for stale_name in stale_names - set(names):
+        _remove_if_exists(pjoin(final_path, stale_name))
+
+    # Renaming a hardlink onto another link of the same file is a no-op that
+    # leaves the source behind
+    shutil.rmtree(tmp_path)
+
+
+def bump_generation(lt_dir):
+    """Marks lt_dir as changed for the search index
+
+    New records already change the mtime of lt_dir, this also catches
+    records that were overwritten in place.
+    """
+    generation_path = pjoin(lt_dir, GENERATION_FILE)
+    with open(generation_path, 'a'):
+        os.utime(generation_path, None)
+
+
+def shard_name(hash_code):
+    """Directory of a record in the sharded layout, two hex digits of the
+    md5 of its name whatever the hash algorithm"""
+    return new_hash('md5', hash_code.encode('utf-8')).hexdigest()[:2]
+
+
+def is_shard(name):
+    return len(name) == 2 and _HEX.issuperset(name)
+
+
+def is_sharded(lt_dir):
+    """Whether new records of lt_dir go to lt_dir/<shard>/<hash_code>"""
+    return os.path.exists(pjoin(lt_dir, SHARDED_FILE))
+
+
+def record_paths(lt_dir, hash_code):
+    """(sharded, flat) paths of a record"""
+    return (pjoin(lt_dir, shard_name(hash_code), hash_code),
+            pjoin(lt_dir, hash_code))
+
+
+def find_record(lt_dir, hash_code):
+    """Path of a record in either layout, None if there is no such record"""
+    for record_path in record_paths(lt_dir, hash_code):
+        if os.path.isdir(record_path):
+            return record_path
+
+    return None
+
+
+def record_lt_dir(record_path):
+    """The lt_dir of a record path of either layout"""
+    record_path = os.path.normpath(record_path)
+    parent = os.path.dirname(record_path)
+    if os.path.basename(parent) == shard_name(os.path.basename(record_path)):
+        return os.path.dirname(parent)
+
+    return parent
+
+
+def iter_record_dirs(lt_dir):
+    """Yields the DirEntry of every record dir of lt_dir, of either layout
+
+    Record dirs are told apart by their LT...LT name and shard dirs by their
+    two hex digits, without a stat of their own.
+    """
+    try:
+        entries = os.scandir(lt_dir)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            name = entry.name
+            if len(name) >= 4 and name[:2] == 'LT' and name[-2:] == 'LT':
+                if entry.is_dir():
+                    yield entry
+            elif is_shard(name) and entry.is_dir():
+                for shard_entry in iter_record_dirs(entry.path):
+                    yield shard_entry
+
+
+def reshard(lt_dir, sharded=True):
+    """Moves every record of lt_dir to the sharded or the flat layout,
+    returns how many were moved
+
+    The layout is switched first so new records already go to the new one.
+    Each record is moved with a single rename and is found in either layout
+    meanwhile, so it is safe to run alongside writers and searches.
+    """
+    sharded_file = pjoin(lt_dir, SHARDED_FILE)
+    if sharded:
+        with open(sharded_file, 'a'):
+            pass
+    else:
+        _remove_if_exists(sharded_file)
+
+    moved = 0
+    for entry in list(iter_record_dirs(lt_dir)):
+        dst_path = record_paths(lt_dir, entry.name)[0 if sharded else 1]
+        if os.path.normpath(entry.path) == os.path.normpath(dst_path):
+            continue
+
+        makedirs(os.path.dirname(dst_path))
+        try:
+            os.rename(entry.path, dst_path)
+        except OSError:
+            if not os.path.isdir(dst_path):
+                raise
+            # Rewritten in the new layout since it was listed
+            shutil.rmtree(entry.path, ignore_errors=True)
+        moved += 1
+
+    if not sharded:
+        for name in os.listdir(lt_dir):
+            if is_shard(name):
+                try:
+                    os.rmdir(pjoin(lt_dir, name))
+                except OSError:
+                    pass
+
+    bump_generation(lt_dir)
+
+    return moved
+
+
+def walk_files(paths):
+    """Expands untracked files and folders into the files they contain"""
+    for path in paths:
+        path = os.path.normpath(path)
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                yield pjoin(dir_path, file_name)
+
+
+def format_manifest(manifest, algorithm=DEFAULT_ALGORITHM):
+    """Formats {path: digest} as '<digest>\t<path>' lines after a header
+    naming the hash algorithm"""
+    lines = ['#algorithm\t{}\n'.format(algorithm)]
+    lines.extend('{}\t{}\n'.format(manifest[path], path)
+                 for path in sorted(manifest))
+
+    return ''.join(lines)
+
+
+def parse_manifest(text):
+    """Returns ({path: digest}, algorithm)"""
+    manifest = dict()
+    algorithm = DEFAULT_ALGORITHM
+    for line in text.splitlines():
+        if line.startswith('#algorithm\t'):
+            algorithm = line.split('\t', 1)[1]
+        elif line:
+            digest, path = line.split('\t', 1)
+            manifest[path] = digest
+
+    return manifest, algorithm
+
+
+def read_manifest(record_path):
+    """Returns ({path: digest}, algorithm) of the untracked files"""
+    return parse_manifest(read_record_file(record_path, MANIFEST_FILE) or '')
+
+
+def default_blobs_root(record_path):
+    return pjoin(record_lt_dir(record_path), 'blobs')
+
+
+def read_patch(record_path, blobs_root=None):
+    """Reads diff.patch, rebuilding it from its base when stored as a delta"""
+    patch = read_record_file(record_path, PATCH_FILE)
+    if patch is not None:
+        return patch
+
+    if blobs_root is None:
+        blobs_root = default_blobs_root(record_path)
+
+    return patch_from_delta(read_record_file(record_path, DELTA_FILE), blobs_root)
+
+
+def patch_from_delta(delta, blobs_root):
+    """Rebuilds a patch from the text of diff.delta, None without one"""
+    if delta is None:
+        return None
+
+    delta = json.loads(delta)
+    blob_store = BlobStore(blobs_root, delta.get('algorithm', DEFAULT_ALGORITHM))
+    base = blob_store.get_bytes(delta['base']).decode('utf-8')
+
+    return apply_delta(base, delta['ops'])
+
+
+def patch_base(bases_dir, blob_store, git_label, patch):
+    """Returns the digest of the base patch of git_label
+
+    The first patch recorded for a git_label becomes its base for good, the
+    base is in the blob store and bases_dir maps the label to its digest.
+    """
+    bases_dir = pjoin(bases_dir, blob_store.algorithm)
+    base_path = pjoin(bases_dir, git_label.replace(os.path.sep, '_'))
+    if not os.path.exists(base_path):
+        digest = blob_store.put_bytes(patch.encode('utf-8'))
+        makedirs(bases_dir)
+
+        # Linking does not replace an existing base, first writer wins
+        with atomic_write(base_path, 'w', link=True) as tmp_file:
+            tmp_file.write(digest)
+
+    with open(base_path, 'r') as base_file:
+        return base_file.read().strip()
+
+
+def make_delta(base, text):
+    """Line delta of text against base: [start, end] copies base lines,
+    strings are inserted as is"""
+    base_lines = base.splitlines(True)
+    lines = text.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, base_lines, lines)
+
+    ops = list()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(lines[j1:j2]))
+
+    return ops
+
+
+def apply_delta(base, ops):
+    base_lines = base.splitlines(True)
+    parts = list()
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(base_lines[op[0]:op[1]])
+        else:
+            parts.append(op)
+
+    return ''.join(parts)
+
+
+def write_record_files(record_path, files, record_format='dir', compress_level=6):
+    """Writes [(name, text)] as loose files or streams them into one archive
+
+    The archive formats keep a record down to its settings file and a single
+    compressed archive, the settings stay outside so they can be read
+    without opening it. Record files left by an older write of the record
+    are removed, they would shadow the new ones.
+    """
+    names = set(name for name, _ in files)
+
+    if record_format == 'dir':
+        for name, text in files:
+            with open(pjoin(record_path, name), 'w') as record_file:
+                record_file.write(text)
+        for stale_name in set(RECORD_FILES) - names:
+            _remove_if_exists(pjoin(record_path, stale_name))
+        for archive_format in ARCHIVE_FORMATS:
+            _remove_if_exists(pjoin(record_path, ARCHIVE_FILE.format(archive_format)))
+        return
+
+    if record_format not in ARCHIVE_FORMATS:
+        raise ValueError('record_format needs to be [dir/{}]'.format(
+            '/'.join(sorted(ARCHIVE_FORMATS))))
+
+    compression = ARCHIVE_FORMATS[record_format]
+    level_kwarg = 'preset' if compression == 'xz' else 'compresslevel'
+    archive_path = pjoin(record_path, ARCHIVE_FILE.format(record_format))
+
+    with atomic_write(archive_path) as tmp_file:
+        with tarfile.open(fileobj=tmp_file, mode='w:' + compression,
+                          **{level_kwarg: compress_level}) as archive:
+            for name, text in files:
+                data = text.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = time.time()
+                archive.addfile(info, io.BytesIO(data))
+
+    for stale_name in RECORD_FILES:
+        _remove_if_exists(pjoin(record_path, stale_name))
+    for archive_format in set(ARCHIVE_FORMATS) - set([record_format]):
+        _remove_if_exists(pjoin(record_path, ARCHIVE_FILE.format(archive_format)))
+
+
+def read_record_file(record_path, name):
+    """Reads a record file from either layout, returns None if it is missing"""
+    loose_path = pjoin(record_path, name)
+    if os.path.exists(loose_path):
+        with open(loose_path, 'r') as record_file:
+            return record_file.read()
+
+    for record_format in sorted(ARCHIVE_FORMATS):
+        archive_path = pjoin(record_path, ARCHIVE_FILE.format(record_format))
+        if not os.path.exists(archive_path):
+            continue
+
+        with tarfile.open(archive_path, 'r:*') as archive:
+            try:
+                member = archive.extractfile(name)
+            except KeyError:
+                continue
+            return member.read().decode('utf-8')
+
+    return None
+
+
+def _remove_if_exists(path):
+    if os.path.exists(path):
+        os.remove(path)
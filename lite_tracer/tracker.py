@@ -5,67 +5,116 @@
 # Author: Yanshuai Cao
 
 from __future__ import print_function
-import hashlib
+import json
 from argparse import ArgumentParser
 import subprocess
 import shutil
 import os
 from os.path import join as pjoin
 import re
+import time
+import atexit
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
+import lite_tracer.backends as backends
 import lite_tracer.exceptions as exception
+import lite_tracer.hashing as hashing
+import lite_tracer.store as store
 
 
 class LTParser(ArgumentParser):
     """Lite tracer parses arugments and saves them for future tracking
 
     Attributes:
-    record_path(str): Directory in which the record will be saved
-    args_file (str): File path for the record text path
+    record_path(str): Directory in which the record will be saved, None
+        unless the storage is dir
+    args_file (str): File path for the record text path, None unless the
+        storage is dir
+    capture_stats (dict): Wall time and summed per-command time of the
+        last git capture, and the time saved by running it concurrently
+    pending_records (list): Futures of the records still being written in
+        the background, see flush
     """
     _BASE_HASH_FIELD = 'base_hash_code'
     _HASH_FIELD = 'hash_code'
     _GIT_FIELD = 'git_label'
     _HASH_FORMAT = 'LT_delta-{}_base-{}_LT'
+    _GIT_CAPTURES = (('git_label', ['git', 'describe', '--always']),
+                     ('git_diff', ['git', 'diff']),
+                     ('git_status', ['git', 'status', '-s']))
 
     def __init__(self, **kwargs):
         self._lt_record_dir = kwargs.pop('record_dir', 'lt_records')
         self._on_suspicion = kwargs.pop('on_suspicion', 'warn')
         self._short_hash = kwargs.pop('short_hash', True)
+        self._use_hash_cache = kwargs.pop('hash_cache', True)
+        self._background = kwargs.pop('background', False)
+        self._record_format = kwargs.pop('record_format', 'dir')
+        self._compress_level = kwargs.pop('compress_level', 6)
+        self._delta_patches = kwargs.pop('delta_patches', False)
+        self._hash_algorithm = hashing.check_algorithm(
+            kwargs.pop('hash_algorithm', hashing.DEFAULT_ALGORITHM))
+        self._hash_workers = kwargs.pop('hash_workers', None)
+        storage = kwargs.pop('storage', 'dir')
+        sharded = kwargs.pop('sharded', None)
+
+        if (self._record_format != 'dir' and
+                self._record_format not in store.ARCHIVE_FORMATS):
+            raise ValueError('record_format needs to be [dir/{}]'.format(
+                '/'.join(sorted(store.ARCHIVE_FORMATS))))
 
         self.record_path = ''
         self.args_file = ''
+        self.capture_stats = dict()
+        self.pending_records = list()
+        self._record_writer = None
 
         self._flag_params = list()
         self._single_params = list()
 
-        if not os.path.exists(self._lt_record_dir):
-            os.makedirs(self._lt_record_dir)
+        store.makedirs(self._lt_record_dir)
+
+        if isinstance(storage, backends.RecordBackend):
+            self._storage = storage
+        else:
+            self._storage = backends.open_storage(
+                self._lt_record_dir, storage, self._hash_algorithm, sharded)
+        self._local_storage = isinstance(self._storage, backends.LocalBackend)
+        if self._local_storage:
+            self._blob_store = self._storage.blob_store
+        elif self._record_format != 'dir' or self._delta_patches:
+            raise ValueError('record_format and delta_patches need the dir storage')
+
+        self._hash_cache_path = pjoin(
+            self._lt_record_dir, '.hash_cache.{}.json'.format(self._hash_algorithm))
+        self._patch_bases_dir = pjoin(self._lt_record_dir, 'patch_bases')
+        self._snapshots_dir = pjoin(self._lt_record_dir, 'snapshots')
 
         super(LTParser, self).__init__(**kwargs)
 
     def parse_args(self, args=None, namespace=None):
         args = super(LTParser, self).parse_args(args, namespace)
 
-        try:
-            git_label = self._shell_output(["git", "describe", "--always"])
-        except RuntimeError:
-            raise exception.GitError()
-
-        hash_code = self._args_to_hash(args, short=self._short_hash)
-        setattr(args, self._GIT_FIELD, git_label)
-        setattr(args, self._BASE_HASH_FIELD, hash_code)
+        captured = self._capture_git()
+        snapshot = self._hash_unclean(captured)
 
-        args = self._handle_unclean(args)
+        return self._record_args(args, snapshot)
 
-        setting_fname = pjoin(self.record_path,
-                              'settings_{}'.format(args.hash_code))
-        self.args_file = setting_fname + '.txt'
+    def parse_many(self, args_list):
+        """Parses and records many argument lists from one snapshot
 
-        with open(self.args_file, 'w') as write_file:
-            write_file.write(self._args_to_str(args))
+        git is queried and the working tree hashed once, every record links
+        the same snapshot so the cost grows with the number of configs, not
+        with the size of the repository. record_path and args_file are the
+        ones of the last config.
+        """
+        snapshot = self._hash_unclean(self._capture_git())
 
-        return args
+        return [self._record_args(super(LTParser, self).parse_args(args),
+                                  snapshot)
+                for args in args_list]
 
     def add_argument(self, *args, **kwargs):
         if len(args) == 1 and args[0].count('-') == 1:
@@ -81,44 +130,178 @@ class LTParser(ArgumentParser):
 
         super(LTParser, self).add_argument(*args, **kwargs)
 
-    def _handle_unclean(self, args):
-        unclean_hash = hashlib.md5()
-        base_hash = getattr(args, self._BASE_HASH_FIELD)
+    def flush(self, timeout=None):
+        """Waits for the background record writes, re-raises their errors"""
+        pending, self.pending_records = self.pending_records, list()
+        for future in pending:
+            future.result(timeout)
+
+    def _flush_at_exit(self):
+        """Reports a background record that was not written, the process
+        then exits as it would have so the atexit handlers and file buffers
+        of the program still run"""
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+            print('lite_tracer: the record of this run was not written, '
+                  'call flush() to fail on it', file=sys.stderr)
+
+    def _check_pending(self):
+        """Re-raises the error of a background write that already failed"""
+        for future in self.pending_records:
+            if future.done() and future.exception() is not None:
+                self.pending_records.remove(future)
+                raise future.exception()
+
+    def _record_args(self, args, snapshot):
+        self._check_pending()
+        hash_code = self._args_to_hash(args, short=self._short_hash)
+        setattr(args, self._GIT_FIELD, snapshot['git_label'])
+        setattr(args, self._BASE_HASH_FIELD, hash_code)
+
+        return self._handle_unclean(args, snapshot)
+
+    def _hash_unclean(self, captured):
+        """Hashes the uncommitted state shared by every config of a run"""
+        unclean_hash = hashing.new_hash(self._hash_algorithm)
+
+        git_diff = self._update_diff_hash(unclean_hash, captured['git_diff'])
+        untracked_files, digests = self._update_untracked_hash(
+            unclean_hash, captured['git_status'])
 
-        # Update the hash
-        git_diff = self._update_diff_hash(unclean_hash)
-        untracked_files = self._update_untracked_hash(unclean_hash)
+        return {'git_label': captured['git_label'],
+                'git_diff': git_diff,
+                'untracked_files': untracked_files,
+                'digests': digests,
+                'unclean_hash': self._hash_to_str(unclean_hash),
+                # The short hash is for hash_code only, snapshots are shared
+                # by every record of their key so it must not collide
+                'unclean_digest': unclean_hash.hexdigest()}
 
-        unclean_hash_str = self._hash_to_str(unclean_hash)
-        hash_text = self._HASH_FORMAT.format(unclean_hash_str, base_hash)
+    def _handle_unclean(self, args, snapshot):
+        base_hash = getattr(args, self._BASE_HASH_FIELD)
+        hash_text = self._HASH_FORMAT.format(snapshot['unclean_hash'], base_hash)
         setattr(args, self._HASH_FIELD, hash_text)
 
         # Check if Directories exist and error according to preference
-        self.record_path = pjoin(self._lt_record_dir, hash_text)
+        settings_name = 'settings_{}'.format(hash_text)
+        if self._local_storage:
+            self.record_path = self._storage.location(hash_text)
+            self.args_file = pjoin(self.record_path, settings_name + '.txt')
+        else:
+            # Nothing is on disk at a path, the storage has the record
+            self.record_path = self.args_file = None
 
         # TODO: Default is to create another directory with timestamp
-        if os.path.exists(self.record_path):
+        if self._storage.has_record(hash_text):
             msg = "Experiment {} already exists.".format(hash_text)
-            if self._on_suspicion == 'warn':
-                import warnings
-                warnings.warn(msg + " Overwriting previous record now.")
-            elif self._on_suspicion == 'error':
-                raise ValueError(msg)
-            elif self._on_suspicion == 'ignore':
-                pass
-            else:
-                raise ValueError('on_suspicion needs to be [warn/error/ignore]')
+            self._suspicion(msg, " Overwriting previous record now.")
+
+        settings_files = [(settings_name + '.txt', self._args_to_str(args)),
+                          (settings_name + '.json', self._args_to_json(args))]
+        if self._background:
+            # The hash is final, the copies can finish while the job runs
+            future = self._get_record_writer().submit(
+                self._write_record, hash_text, settings_files, snapshot)
+            self.pending_records.append(future)
         else:
-            os.makedirs(self.record_path)
-
-        # Save the diff and the untracked_files in to a directory
-        with open(pjoin(self.record_path, 'diff.patch'), 'w') as git_diff_file:
-            git_diff_file.write(git_diff)
-
-        self._save_untracked(untracked_files)
+            self._write_record(hash_text, settings_files, snapshot)
 
         return args
 
+    def _write_record(self, hash_code, settings_files, snapshot):
+        """Writes the record through the storage in one go, so concurrent
+        runs never see or create a partial record
+
+        Local records hardlink the files of the snapshot, other backends are
+        given the diff and the manifest with the settings.
+        """
+        if not self._local_storage:
+            self._storage.write_record(
+                hash_code, self._snapshot_files(snapshot) + settings_files)
+            return
+
+        snapshot_path = self._write_snapshot(snapshot)
+        links = [(name, pjoin(snapshot_path, name))
+                 for name in os.listdir(snapshot_path)]
+        self._storage.write_record(hash_code, settings_files, links)
+
+    def _write_snapshot(self, snapshot):
+        """Writes the diff and the untracked manifest once per code state
+
+        Records hardlink their files from the snapshot. The first process to
+        take the lock writes it, processes launched alongside reuse it.
+        """
+        layout = self._record_format + ('-delta' if self._delta_patches else '')
+        snapshot_name = '{}_{}_{}'.format(
+            snapshot['git_label'].replace(os.path.sep, '_'),
+            snapshot['unclean_digest'], layout)
+        snapshot_path = pjoin(self._snapshots_dir, snapshot_name)
+
+        if os.path.exists(snapshot_path):
+            return snapshot_path
+
+        store.makedirs(self._snapshots_dir)
+
+        with store.FileLock(pjoin(self._snapshots_dir, '.lock')):
+            if os.path.exists(snapshot_path):
+                return snapshot_path
+
+            tmp_path = store.make_temp_dir(self._snapshots_dir)
+            try:
+                store.write_record_files(tmp_path, self._snapshot_files(snapshot),
+                                         self._record_format,
+                                         self._compress_level)
+                os.rename(tmp_path, snapshot_path)
+            except BaseException:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+
+        return snapshot_path
+
+    def _snapshot_files(self, snapshot):
+        """Saves the diff and the manifest of the untracked files, their
+        content goes to the blob store shared by all the records
+
+        They are kept in the snapshot, the untracked files are stored once
+        however many records are made from it.
+        """
+        if 'files' not in snapshot:
+            manifest = self._save_untracked(snapshot['untracked_files'],
+                                            snapshot['digests'])
+            snapshot['files'] = [
+                self._patch_record_file(snapshot['git_label'],
+                                        snapshot['git_diff']),
+                (store.MANIFEST_FILE,
+                 store.format_manifest(manifest, self._hash_algorithm))]
+
+        return snapshot['files']
+
+    def _patch_record_file(self, git_label, git_diff):
+        """diff.patch, or its delta against the base patch of git_label"""
+        if not self._delta_patches or not git_diff:
+            return store.PATCH_FILE, git_diff
+
+        base_digest = store.patch_base(self._patch_bases_dir, self._blob_store,
+                                       git_label, git_diff)
+        base = self._blob_store.get_bytes(base_digest).decode('utf-8')
+        delta = json.dumps({'algorithm': self._hash_algorithm,
+                            'base': base_digest,
+                            'ops': store.make_delta(base, git_diff)})
+
+        if len(delta) >= len(git_diff):
+            return store.PATCH_FILE, git_diff
+
+        return store.DELTA_FILE, delta
+
+    def _get_record_writer(self):
+        if self._record_writer is None:
+            self._record_writer = ThreadPoolExecutor(max_workers=1)
+            atexit.register(self._flush_at_exit)
+
+        return self._record_writer
+
     def _args_to_str(self, args_parse_obj, filter_keys=None):
         if filter_keys is None:
             filter_keys = [self._HASH_FIELD, self._BASE_HASH_FIELD, 'record_path']
@@ -130,6 +313,40 @@ class LTParser(ArgumentParser):
 
         return ' '.join(self._cmd_to_str(sorted_cmd_items))
 
+    def _args_to_json(self, args_parse_obj):
+        """Typed settings with the argparse metadata of every parameter"""
+        actions = dict((action.dest, action) for action in self._actions)
+        hash_fields = [self._HASH_FIELD, self._BASE_HASH_FIELD]
+
+        params = dict()
+        for key, value in vars(args_parse_obj).items():
+            if key in hash_fields or key == 'record_path':
+                continue
+
+            action = actions.get(key)
+            arg_type = getattr(action, 'type', None)
+            params[key] = {
+                'value': self._json_value(value),
+                'type': getattr(arg_type, '__name__', None),
+                'nargs': getattr(action, 'nargs', None),
+                'flag': key in self._flag_params,
+                'single': key in self._single_params}
+
+        settings = dict((k, getattr(args_parse_obj, k, None)) for k in hash_fields)
+        settings['version'] = 1
+        settings['params'] = params
+
+        return json.dumps(settings, sort_keys=True)
+
+    @classmethod
+    def _json_value(cls, value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [cls._json_value(v) for v in value]
+
+        return str(value)
+
     def _cmd_to_str(self, cmd_items):
         cmd_str = list()
 
@@ -154,35 +371,57 @@ class LTParser(ArgumentParser):
 
         return cmd_str
 
-    def _update_diff_hash(self, md5_hash):
-        try:
-            git_diff = self._shell_output(['git', 'diff'])
-        except RuntimeError:
-            raise exception.GitError()
-
-        md5_hash.update(git_diff.encode('utf-8'))
+    def _capture_git(self):
+        """Runs the git queries concurrently, returns {name: output}"""
+        def timed_output(cmd):
+            start = time.time()
+            output = self._shell_output(cmd)
+            return output, time.time() - start
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(self._GIT_CAPTURES)) as pool:
+            futures = [(name, pool.submit(timed_output, cmd))
+                       for name, cmd in self._GIT_CAPTURES]
+
+        captured = dict()
+        serial_time = 0.0
+        for name, future in futures:
+            try:
+                captured[name], elapsed = future.result()
+            except RuntimeError:
+                raise exception.GitError()
+            serial_time += elapsed
+
+        wall_time = time.time() - start
+        self.capture_stats = {'wall_time': wall_time,
+                              'serial_time': serial_time,
+                              'saved_time': max(serial_time - wall_time, 0.0)}
+
+        return captured
+
+    def _update_diff_hash(self, unclean_hash, git_diff):
+        unclean_hash.update(git_diff.encode('utf-8'))
 
         return git_diff
 
-    def _update_untracked_hash(self, md5_hash):
-        untracked_files = self._find_untracked()
-        files, folders = self._sort_files_folders(untracked_files)
+    def _update_untracked_hash(self, unclean_hash, git_status):
+        untracked_files = self._find_untracked(git_status)
+        _, folders = self._sort_files_folders(untracked_files)
 
         if folders:
             self._folder_error_msg(folders)
 
-        untracked_content = self._read_untracked_files(files)
-        md5_hash.update(''.join(untracked_content).encode('utf-8'))
+        # Each file, those of untracked folders included, is hashed on its
+        # own in bounded chunks, the combined hash only sees the (path,
+        # digest) pairs in a deterministic order
+        digests = self._digest_untracked_files(store.walk_files(untracked_files))
+        for path in sorted(digests):
+            unclean_hash.update(
+                '{}\0{}\0'.format(path, digests[path]).encode('utf-8'))
 
-        # find self._lt_record_dir and remove any content underneath
-        return untracked_files
-
-    def _find_untracked(self):
-        try:
-            git_untracked = self._shell_output(["git", "status", "-s"])
-        except RuntimeError:
-            raise exception.GitError()
+        return untracked_files, digests
 
+    def _find_untracked(self, git_untracked):
         escaped_dir = re.escape(self._lt_record_dir + '/')
         regex_string = '(?<=\?\? )(?!\.|{}).*'.format(escaped_dir)
         untracked_regex = re.compile(regex_string)
@@ -198,23 +437,31 @@ class LTParser(ArgumentParser):
 
         return files, folders
 
-    @staticmethod
-    def _read_untracked_files(files):
-        content = list()
-        for path in files:
-            with open(path, 'r') as file_handler:
-                content.append(file_handler.read())
+    def _digest_untracked_files(self, files):
+        files = [os.path.normpath(path) for path in files]
+        if not self._use_hash_cache:
+            return hashing.digest_files(files, self._hash_algorithm,
+                                        workers=self._hash_workers)
+
+        hash_cache = hashing.HashCache(self._hash_cache_path, self._hash_algorithm)
+        digests = hashing.digest_files(files, self._hash_algorithm, hash_cache,
+                                       workers=self._hash_workers)
+        hash_cache.evict_stale()
+        hash_cache.save()
 
-        return content
+        return digests
 
     def _folder_error_msg(self, folders):
         folder_str = ', '.join(folders)
         msg = ("{} are folders not checked in. "
                "Consider adding it to .gitignore or git add".format(folder_str))
 
+        self._suspicion(msg, " Will backup the folder for now.")
+
+    def _suspicion(self, msg, warn_msg):
         if self._on_suspicion == 'warn':
             import warnings
-            warnings.warn(msg + " Will backup the folder for now.")
+            warnings.warn(msg + warn_msg)
         elif self._on_suspicion == 'error':
             raise ValueError(msg)
         elif self._on_suspicion == 'ignore':
@@ -222,37 +469,33 @@ class LTParser(ArgumentParser):
         else:
             raise ValueError('on_suspicion needs to be [warn/error/ignore]')
 
-    def _save_untracked(self, untracked_files, save_folder='untracked'):
-        untracked_save_path = pjoin(self.record_path, save_folder)
-
-        if not os.path.exists(untracked_save_path):
-            os.makedirs(untracked_save_path)
+    def _save_untracked(self, untracked_files, digests):
+        manifest = dict()
+        for path in store.walk_files(untracked_files):
+            manifest[path] = self._storage.put_blob(path, digests.get(path))
+            if path in digests and manifest[path] != digests[path]:
+                # Its content no longer matches the hash code, whatever
+                # on_suspicion says it must not be recorded under it
+                raise exception.RecordWriteError(
+                    "{} changed after it was hashed, the record was not "
+                    "written.".format(path))
 
-        for u_file in untracked_files:
-            if os.path.isdir(u_file):
-                dst_path = pjoin(untracked_save_path,
-                                 os.path.basename(u_file.rstrip(os.path.sep)))
-                if os.path.exists(dst_path):
-                    shutil.rmtree(dst_path)
-
-                shutil.copytree(u_file, dst_path)
-            else:
-                shutil.copy(u_file, untracked_save_path)
+        return manifest
 
     def _args_to_hash(self, args_parse_obj, short=True):
-        md5_hash = hashlib.md5()
+        args_hash = hashing.new_hash(self._hash_algorithm)
         args_str = self._args_to_str(args_parse_obj)
-        md5_hash.update(args_str.encode('utf-8'))
+        args_hash.update(args_str.encode('utf-8'))
 
-        return self._hash_to_str(md5_hash, short)
+        return self._hash_to_str(args_hash, short)
 
     @staticmethod
-    def _hash_to_str(md5_hash, short=True):
+    def _hash_to_str(hash_obj, short=True):
         if not short:
-            hash_code = md5_hash.hexdigest()
+            hash_code = hash_obj.hexdigest()
         else:
             from zlib import adler32
-            hash_code = hex(adler32(md5_hash.digest()))
+            hash_code = hex(adler32(hash_obj.digest()))
 
         return hash_code
 
@@ -15,4 +15,5 @@ setup(name='lite_tracer',
       license='GNU LGPL',
       packages=['lite_tracer'],
       scripts=['lite_tracer/lite_trace.py'],
+      python_requires='>=3.8',
       zip_safe=False)
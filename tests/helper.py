@@ -13,6 +13,17 @@ def cleandir():
     shutil.rmtree(resboundts_path)
 
 
+@pytest.fixture
+def git_repo(tmpdir):
+    git = 'git -c user.name=lt -c user.email=lt@lt '
+    with tmpdir.as_cwd():
+        tmpdir.join('train.py').write('print("train")\n')
+        subprocess.check_output(git + 'init -q', shell=True)
+        subprocess.check_output(git + 'add train.py', shell=True)
+        subprocess.check_output(git + 'commit -q -m init', shell=True)
+        yield tmpdir
+
+
 def get_tracer():
     parser = LTParser(description="A reproducible experiment")
 
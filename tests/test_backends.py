@@ -0,0 +1,130 @@
+import os
+import time
+
+import pytest
+
+import lite_tracer
+from lite_tracer import LTParser, backends, hashing
+from lite_tracer.index import SearchIndex
+
+from helper import git_repo
+
+
+def open_kind(tmpdir, kind):
+    return backends.open_storage(str(tmpdir.join('lt_records')), kind)
+
+
+@pytest.mark.parametrize('kind', backends.STORAGE_KINDS)
+def test_backend_round_trip(tmpdir, kind):
+    storage = open_kind(tmpdir, kind)
+    tmpdir.join('lt_records').ensure(dir=True)
+    tmpdir.join('linked.txt').write('linked')
+
+    assert not storage.has_record('LT1LT')
+    storage.write_record('LT1LT', [('settings_LT1LT.txt', '--lr 0.1\n')],
+                         [('diff.patch', str(tmpdir.join('linked.txt')))])
+    storage.write_record('LT2LT', [('settings_LT2LT.txt', '--lr 0.2\n')])
+
+    assert storage.has_record('LT1LT')
+    assert storage.read_file('LT1LT', 'diff.patch') == 'linked'
+    assert storage.read_file('LT2LT', 'diff.patch') is None
+
+    # Overwriting replaces every file of the record
+    storage.write_record('LT1LT', [('settings_LT1LT.txt', '--lr 0.3\n')])
+    assert storage.read_file('LT1LT', 'settings_LT1LT.txt') == '--lr 0.3\n'
+    assert storage.read_file('LT1LT', 'diff.patch') is None
+
+    entries = sorted(storage.list_records(), key=lambda e: e.hash_str)
+    assert [e.hash_str for e in entries] == ['LT1LT', 'LT2LT']
+    assert [storage.parse_record(e).kwargs for e in entries] == \
+        [{'lr': ['0.3']}, {'lr': ['0.2']}]
+
+    tmpdir.join('blob.bin').write_binary(b'\x00\xff' * 10)
+    digest = storage.put_blob(str(tmpdir.join('blob.bin')))
+    assert digest == hashing.file_digest(str(tmpdir.join('blob.bin')))
+    assert storage.has_blob(digest)
+    assert storage.get_blob(digest) == b'\x00\xff' * 10
+
+    # Streamed in chunks, and not read again once stored
+    large = bytes(bytearray(range(256))) * (hashing.CHUNK_SIZE // 128 + 3)
+    tmpdir.join('large.bin').write_binary(large)
+    digest = storage.put_blob(str(tmpdir.join('large.bin')))
+    assert storage.get_blob(digest) == large
+    tmpdir.join('large.bin').remove()
+    assert storage.put_blob(str(tmpdir.join('large.bin')), digest) == digest
+
+
+def test_object_store_collect(tmpdir):
+    storage = open_kind(tmpdir, 'objects')
+    storage.write_record('LT1LT', [('settings_LT1LT.txt', '--lr 0.1\n')])
+    storage.write_record('LT1LT', [('settings_LT1LT.txt', '--lr 0.2\n'),
+                                   ('diff.patch', 'diff')])
+    storage.write_record('LT2LT', [('settings_LT2LT.txt', '--lr 0.3\n')])
+
+    # The replaced version is left to its readers until collected
+    versions = storage.client.list('records/LT1LT/')
+    assert len(set(key.split('/')[2] for key, _ in versions)) == 2
+    assert storage.collect() == 0
+    assert storage.collect(now=time.time() + 7200) == 1
+    assert sorted(key for key, _ in storage.client.list('records/LT1LT/')) == \
+        ['records/LT1LT/{}/{}'.format(storage._commit('LT1LT')['version'], name)
+         for name in ['diff.patch', 'settings_LT1LT.txt']]
+    assert storage.read_file('LT1LT', 'settings_LT1LT.txt') == '--lr 0.2\n'
+    assert storage.read_file('LT2LT', 'settings_LT2LT.txt') == '--lr 0.3\n'
+
+
+@pytest.mark.parametrize('kind', ['sqlite', 'objects'])
+def test_untracked_stored_once(git_repo, monkeypatch, kind):
+    for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']:
+        git_repo.join(name).write(name)
+
+    tracer = LTParser(storage=kind)
+    tracer.add_argument('--seed', type=int)
+    put_blob = tracer._storage.put_blob
+    stored = list()
+
+    def counted_put_blob(src_path, digest=None):
+        stored.append(src_path)
+        return put_blob(src_path, digest)
+
+    monkeypatch.setattr(tracer._storage, 'put_blob', counted_put_blob)
+    tracer.parse_many([['--seed', str(seed)] for seed in range(5)])
+    assert sorted(stored) == ['a.txt', 'b.txt', 'c.txt', 'd.txt']
+
+
+@pytest.mark.parametrize('kind', ['sqlite', 'objects'])
+def test_track_and_search(git_repo, kind):
+    git_repo.join('train.py').write('print("changed")\n')
+    git_repo.join('data.txt').write('data')
+
+    hash_codes = list()
+    for lr in ['0.1', '0.01']:
+        tracer = LTParser(storage=kind)
+        tracer.add_argument('--lr', type=float, default=0.1)
+        hash_codes.append(tracer.parse_args(['--lr', lr]).hash_code)
+        assert tracer.record_path is None and tracer.args_file is None
+
+    # No record directories in lt_records
+    assert not [n for n in os.listdir(str(git_repo.join('lt_records')))
+                if n.startswith('LT')]
+
+    lt_dir = str(git_repo.join('lt_records'))
+    record, = lite_tracer.search(lt_dir, include=['lr>=0.01'], storage=kind)
+    assert record.hash_str == hash_codes[1]
+    assert record.settings['params']['lr']['value'] == 0.01
+    assert 'changed' in record.diff
+    assert list(record.untracked) == ['data.txt']
+    assert record.storage.get_blob(record.untracked['data.txt']) == b'data'
+
+    search_index = SearchIndex(lt_dir, storage=backends.open_storage(lt_dir, kind))
+    assert search_index.update() == 0
+    assert sorted(r.hash_str for r in search_index.search()) == sorted(hash_codes)
+
+
+def test_local_only_options(git_repo):
+    with pytest.raises(ValueError):
+        LTParser(storage='sqlite', delta_patches=True)
+    with pytest.raises(ValueError):
+        LTParser(storage='objects', record_format='tar.gz')
+    with pytest.raises(ValueError):
+        LTParser(storage='s3')
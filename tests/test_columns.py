@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from lite_tracer import backends, columns
+from lite_tracer.columns import ColumnStore
+from lite_tracer.index import SearchIndex
+from lite_tracer.query import Query, get_param_operator_value
+from lite_tracer.records import SETTINGS_FILE, Record
+
+QUERIES = [['lr<=0.01'], ['lr<=0.01', 'bsz>=256'], ['bsz>64', 'bsz<512'],
+           ['optimizer:sgd'], ['optimizer==adam', 'lr'], ['flist:6.01'],
+           ['optimizer<sgd'], ['notes'], ['lr:nan'], ['missing']]
+
+
+def make_records(n_records):
+    rng = random.Random(0)
+    records = list()
+    for i in range(n_records):
+        kwargs = {'lr': [str(rng.choice([0.1, 0.01, 0.001, 'nan']))],
+                  'bsz': [str(rng.choice([32, 64, 256, 512]))],
+                  'optimizer': [rng.choice(['sgd', 'adam', '1e-3'])]}
+        if i % 2:
+            kwargs['flist'] = [str(rng.choice([6.01, 12.01])) for _ in range(i % 3)]
+        if i % 5 == 0:
+            kwargs['notes'] = ['research']
+        hash_str = 'LT{}LT'.format(i)
+        settings_path = '/lt_records/{0}/settings_{0}.txt'.format(hash_str)
+        records.append(Record(hash_str, i, settings_path, kwargs))
+
+    return records
+
+
+def indexed(tmpdir, records):
+    """SearchIndex of the records, written to a sqlite backend"""
+    storage = backends.SqliteBackend(str(tmpdir.join('records.sqlite')))
+    for record in records:
+        line = ' '.join('--{} {}'.format(key, ' '.join(values)).strip()
+                        for key, values in sorted(record.kwargs.items()))
+        storage.write_record(record.hash_str,
+                             [(SETTINGS_FILE.format(record.hash_str), line + '\n')])
+
+    search_index = SearchIndex(str(tmpdir), ':memory:', storage=storage)
+    search_index.update()
+    return search_index
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_select_matches_index(tmpdir, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+        monkeypatch.setattr(columns, 'VECTORIZE_MIN_RECORDS', 0)
+
+    search_index = indexed(tmpdir, make_records(200))
+    store = ColumnStore(search_index.records())
+    assert (store._np is not None) == use_numpy
+    for include in QUERIES + [[]]:
+        for exclude in QUERIES[::3] + [[]]:
+            query = Query(get_param_operator_value(include),
+                          get_param_operator_value(exclude))
+            expected = [r.hash_str for r in
+                        search_index.records(search_index.select(query))]
+            assert sorted(store.hash_strs[row] for row in store.select(query)) == \
+                sorted(expected)
+
+
+def test_compact_records():
+    records = make_records(50)
+    store = ColumnStore(iter(records))
+
+    assert len(store) == 50
+    for row, record in enumerate(records):
+        compact = store.record(row)
+        assert (compact.hash_str, compact.ctime, compact.settings_path, compact.kwargs) == \
+            (record.hash_str, record.ctime, record.settings_path, record.kwargs)
+
+    # Distinct values are held once
+    assert sorted(store.column('bsz').values) == ['256', '32', '512', '64']
+    first, second = [row for row, record in enumerate(records)
+                     if record.kwargs['bsz'] == records[0].kwargs['bsz']][:2]
+    assert store.record(first).kwargs['bsz'][0] is store.record(second).kwargs['bsz'][0]
+
+
+def test_load(tmpdir):
+    records = make_records(50)
+    indexed(tmpdir, records).close()
+
+    store = columns.load(str(tmpdir), storage='sqlite')
+    assert sorted(store.hash_strs) == sorted(r.hash_str for r in records)
+    assert store.record(store.hash_strs.index('LT7LT')).kwargs == records[7].kwargs
+    query = Query(get_param_operator_value(['optimizer:sgd']))
+    assert sorted(store.hash_strs[row] for row in store.select(query)) == \
+        sorted(r.hash_str for r in records if r.kwargs['optimizer'] == ['sgd'])
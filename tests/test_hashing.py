@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+from lite_tracer import LTParser, hashing
+from helper import git_repo
+
+
+def test_hash_cache(tmpdir, monkeypatch):
+    data_file = tmpdir.join('data.bin')
+    data_file.write_binary(b'\x00' * 1024)
+    old = time.time() - 60
+    os.utime(str(data_file), (old, old))
+
+    cache_path = str(tmpdir.join('cache.json'))
+    cache = hashing.HashCache(cache_path)
+    digest = cache.digest(str(data_file))
+    cache.save()
+    assert digest == hashing.file_digest(str(data_file))
+
+    calls = list()
+    original_digest = hashing.file_digest
+    monkeypatch.setattr(hashing, 'file_digest',
+                        lambda *args: calls.append(args) or original_digest(*args))
+
+    # A fresh cache from disk
+    cache = hashing.HashCache(cache_path)
+    assert cache.digest(str(data_file)) == digest
+    cache.save()
+    assert not calls
+
+    data_file.write_binary(b'\x01' * 1024)
+    os.utime(str(data_file), (old + 1, old + 1))
+    cache = hashing.HashCache(cache_path)
+    assert cache.digest(str(data_file)) != digest
+    cache.save()
+    assert len(calls) == 1
+
+    data_file.remove()
+    cache = hashing.HashCache(cache_path)
+    cache.evict_stale()
+    cache.save()
+    assert not hashing.HashCache(cache_path)._entries
+
+
+def test_hash_algorithms(git_repo):
+    for i in range(8):
+        git_repo.join('data_{}.bin'.format(i)).write_binary(os.urandom(4096))
+
+    hash_codes = set()
+    for algorithm in ['md5', 'sha256', 'blake2b']:
+        serial = LTParser(hash_algorithm=algorithm, hash_workers=1,
+                          hash_cache=False).parse_args([])
+        parallel = LTParser(hash_algorithm=algorithm, hash_workers=4).parse_args([])
+        assert serial.hash_code == parallel.hash_code
+        hash_codes.add(serial.hash_code)
+
+    assert len(hash_codes) == 3
+
+    with pytest.raises(ValueError):
+        LTParser(hash_algorithm='not_a_hash')
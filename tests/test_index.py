@@ -0,0 +1,235 @@
+import os
+import subprocess
+import time
+
+import lite_tracer
+from lite_tracer import index
+from lite_tracer.index import SearchIndex
+from lite_tracer.query import Query, get_param_operator_value
+from lite_tracer.records import parse_setting_file, scan_records
+from lite_tracer.store import GENERATION_FILE
+
+import helper
+from helper import git_repo
+
+
+def age(*paths):
+    old = time.time() - 60
+    for path in paths:
+        os.utime(str(path), (old, old))
+
+
+def test_incremental_index(git_repo):
+    for i in range(4):
+        helper.get_tracer().parse_args(helper.generate_sysv(i, False))
+
+    lt_dir = git_repo.join('lt_records')
+    age(lt_dir, lt_dir.join(GENERATION_FILE))
+
+    search_index = SearchIndex(str(lt_dir))
+    assert search_index.update() == 4
+    assert search_index.update() == 0
+    assert sorted(int(r.kwargs['integer'][0]) for r in search_index.records()) == [0, 1, 2, 3]
+
+    # A new record and an overwritten one
+    helper.get_tracer().parse_args(helper.generate_sysv(4, False))
+    args = helper.get_tracer().parse_args(helper.generate_sysv(0, False))
+    settings = lt_dir.join(args.hash_code, 'settings_{}.txt'.format(args.hash_code))
+    age(settings)
+
+    search_index = SearchIndex(str(lt_dir))
+    assert search_index.update() == 2
+    assert len(list(search_index.records())) == 5
+
+
+def test_warm_update(git_repo, monkeypatch):
+    for i in range(2):
+        helper.get_tracer().parse_args(helper.generate_sysv(i, False))
+
+    lt_dir = git_repo.join('lt_records')
+    search_index = SearchIndex(str(lt_dir))
+    assert search_index.update() == 2
+    age(lt_dir, lt_dir.join(GENERATION_FILE))
+    assert search_index.update() == 0
+
+    # Writing the index did not change the stamp, the records are not listed
+    def list_records():
+        raise AssertionError('listed the records of an unchanged lt_dir')
+
+    monkeypatch.setattr(search_index.storage, 'list_records', list_records)
+    assert search_index.update() == 0
+    assert len(list(search_index.search(['integer:1']))) == 1
+    assert search_index.update() == 0
+
+
+def test_missing_lt_dir(tmpdir):
+    lt_dir = tmpdir.join('lt_records')
+    search_index = SearchIndex(str(lt_dir))
+    assert search_index.index_path == ':memory:'
+    assert search_index.update() == 0
+    assert not list(lite_tracer.search(str(lt_dir)))
+
+    with tmpdir.as_cwd():
+        assert subprocess.call(['lite_trace.py', '-i', 'lr'],
+                               stdout=subprocess.DEVNULL) == 1
+    assert not lt_dir.exists()
+
+
+def test_structured_settings(git_repo):
+    tracer = helper.get_tracer()
+    helper.add_lists_option(tracer)
+    helper.add_notes_option(tracer)
+    helper.add_boolean_option(tracer)
+    args = tracer.parse_args(helper.generate_sysv(3))
+
+    lt_dir = git_repo.join('lt_records')
+    legacy_file = lt_dir.join(args.hash_code, 'settings_{}.txt'.format(args.hash_code))
+    structured = parse_setting_file(str(legacy_file))
+
+    assert structured.hash_str == args.hash_code
+    assert structured.kwargs['notes'] == [' Ground Breaking Research ']
+    assert structured.kwargs['optimizer'] == ['a,b,c,d']
+    assert structured.kwargs['flist'] == ['6.01', '12.01']
+    assert structured.kwargs['boolean'] == ['False']
+
+    # Records written before the structured settings
+    lt_dir.join(args.hash_code, 'settings_{}.json'.format(args.hash_code)).remove()
+    legacy = parse_setting_file(str(legacy_file))
+    assert legacy.kwargs['optimizer'] == ['abcd']
+    assert legacy.kwargs['flist'] == structured.kwargs['flist']
+
+
+def test_parallel_index(git_repo, monkeypatch):
+    for i in range(6):
+        helper.get_tracer().parse_args(helper.generate_sysv(i, False))
+
+    lt_dir = git_repo.join('lt_records')
+    serial = SearchIndex(str(lt_dir), index_path=':memory:', workers=1)
+    assert serial.update() == 6
+
+    monkeypatch.setattr(SearchIndex, '_PARALLEL_MIN_FILES', 0)
+    monkeypatch.setattr(index, 'CHUNK_FILES', 4)
+    progress = list()
+    parallel = SearchIndex(str(lt_dir), index_path=':memory:', workers=2)
+    assert parallel.update(lambda done, total: progress.append((done, total))) == 6
+
+    assert progress == [(4, 6), (6, 6)]
+    assert [(r.hash_str, r.ctime, r.kwargs) for r in parallel.records()] == \
+        [(r.hash_str, r.ctime, r.kwargs) for r in serial.records()]
+
+
+def test_select(git_repo):
+    for i in range(6):
+        tracer = helper.get_tracer()
+        if i % 2:
+            helper.add_lists_option(tracer)
+        tracer.parse_args(helper.generate_sysv(i, bool(i % 2)))
+
+    search_index = SearchIndex(str(git_repo.join('lt_records')))
+    search_index.update()
+
+    # Record i has integer i, the odd ones list and flist [2i, 4i] (+0.01).
+    # Patterns compare query OP stored, as included and as excluded.
+    everything = set(range(6))
+    queries = [(['integer<=3'], {3, 4, 5}, {3, 4, 5}),
+               (['integer>3', 'float'], {0, 1, 2}, everything),
+               (['list'], {1, 3, 5}, {1, 3, 5}),
+               (['flist<13'], {5}, {5}),
+               (['device:cuda:0'], {0}, {0}),
+               (['device:cpu'], set(), set()),
+               (['integer<3', 'list'], {5}, {1, 3, 4, 5}),
+               ([], everything, set())]
+    for include, included, _ in queries:
+        for exclude, _, excluded in queries:
+            query = Query(get_param_operator_value(include),
+                          get_param_operator_value(exclude))
+            selected = search_index.records(search_index.select(query))
+            assert set(int(r.kwargs['integer'][0]) for r in selected) == \
+                included - excluded
+
+
+def test_ordered(git_repo):
+    hash_codes = list()
+    for i in range(5):
+        args = helper.get_tracer().parse_args(helper.generate_sysv(i, False))
+        hash_codes.append(args.hash_code)
+
+    lt_dir = git_repo.join('lt_records')
+    search_index = SearchIndex(str(lt_dir))
+    search_index.update()
+    record_ids = search_index.select(Query())
+    ctimes = sorted(r.ctime for r in search_index.records())
+
+    ordered = search_index.ordered(record_ids)
+    assert [r.hash_str for r in ordered] == hash_codes
+    ordered = search_index.ordered(record_ids, reverse=True, limit=2)
+    assert [r.hash_str for r in ordered] == hash_codes[:2:-1]
+
+    selected = search_index.select(Query(), since=ctimes[1], until=ctimes[3])
+    assert [r.hash_str for r in search_index.ordered(selected)] == hash_codes[1:4]
+
+    # Settings files older than since are not parsed
+    search_index = SearchIndex(str(lt_dir), index_path=':memory:')
+    assert search_index.update(since=ctimes[3]) == 2
+    assert search_index.update() == 3
+
+
+def test_scan_records(git_repo):
+    hash_codes = sorted(helper.get_tracer().parse_args(helper.generate_sysv(i, False)).hash_code
+                        for i in range(3))
+    lt_dir = git_repo.join('lt_records')
+    lt_dir.mkdir('LT_unfinished_LT')
+
+    entries = sorted(scan_records(str(lt_dir)), key=lambda e: e.hash_str)
+    assert [e.hash_str for e in entries] == hash_codes
+
+    for entry in entries:
+        parsed = entry.parse()
+        assert parsed.hash_str == entry.hash_str
+        legacy = parse_setting_file(entry.settings_path)
+        assert (parsed.hash_str, parsed.ctime, parsed.kwargs) == \
+            (legacy.hash_str, legacy.ctime, legacy.kwargs)
+
+
+def test_non_defaults(git_repo):
+    args = [helper.get_tracer().parse_args(['--integer', str(i % 2), '--device', 'cpu'])
+            for i in range(3)]
+    lt_dir = git_repo.join('lt_records')
+
+    search_index = SearchIndex(str(lt_dir))
+    search_index.update()
+    assert not search_index.empty()
+    assert search_index.non_defaults() == {'integer'}
+
+    tracer = helper.get_tracer()
+    helper.add_single_option(tracer)
+    tracer.parse_args(['--device', 'cuda:1'])
+    search_index.update()
+    assert search_index.non_defaults() == {'integer', 'device'}
+
+    # Counts follow the records that are removed
+    for hash_code in set(a.hash_code for a in args):
+        lt_dir.join(hash_code).remove()
+    search_index.update()
+    assert search_index.non_defaults() == set()
+
+
+def test_search_api(git_repo):
+    git_repo.join('train.py').write('print("train faster")\n')
+    git_repo.join('data.txt').write('data')
+    hash_codes = [helper.get_tracer().parse_args(helper.generate_sysv(i, False)).hash_code
+                  for i in range(3)]
+
+    lt_dir = str(git_repo.join('lt_records'))
+    # Comparisons read value OP param, integer<=1 is 1 <= integer
+    results = lite_tracer.search(lt_dir, include=['integer<=1'], reverse=True)
+    assert [r.hash_str for r in results] == hash_codes[:0:-1]
+    results = lite_tracer.search(lt_dir, include=['integer>=1'])
+    assert [r.hash_str for r in results] == hash_codes[:2]
+
+    record, = lite_tracer.search(lt_dir, include=['integer:2'], exclude=['device:cpu'])
+    assert not hasattr(record, '__dict__')
+    assert record.kwargs['device'] == ['cuda:2']
+    assert record.settings['hash_code'] == hash_codes[2]
+    assert 'train faster' in record.diff
+    assert list(record.untracked) == ['data.txt']
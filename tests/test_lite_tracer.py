@@ -1,10 +1,13 @@
+import subprocess
+import sys
+
 import pytest
 
-from lite_tracer import LTParser
+from lite_tracer import LTParser, exceptions, hashing
 
 import pdb
 import helper
-from helper import cleandir
+from helper import cleandir, git_repo
 
 
 @pytest.fixture
@@ -66,3 +69,147 @@ def test_arguments_file():
     helper.assert_arguments(args)
     helper.assert_lists(args)
     assert len(unknown) == 2 and unknown[0] == '--git_label'
+
+
+@pytest.mark.usefixtures("cleandir")
+def test_capture_stats():
+    tracer = helper.get_tracer()
+    args = tracer.parse_args([])
+
+    stats = tracer.capture_stats
+    assert args.git_label
+    assert stats['serial_time'] >= 0 and stats['wall_time'] >= 0
+    assert stats['saved_time'] == max(stats['serial_time'] - stats['wall_time'], 0)
+
+
+def test_untracked_binary_hash(git_repo):
+    git_repo.join('weights.bin').write_binary(bytes(bytearray(range(256))) * 64)
+    first = helper.get_tracer().parse_args([])
+    assert first.hash_code == helper.get_tracer().parse_args([]).hash_code
+
+    git_repo.join('weights.bin').write_binary(b'\xff' * 10)
+    assert first.hash_code != helper.get_tracer().parse_args([]).hash_code
+
+
+def test_untracked_folder_hash(git_repo):
+    git_repo.join('data', 'cfg.txt').write('first', ensure=True)
+    tracer = LTParser(on_suspicion='ignore')
+    first = tracer.parse_args([]).hash_code
+
+    git_repo.join('data', 'cfg.txt').write('second')
+    tracer = LTParser(on_suspicion='ignore')
+    second = tracer.parse_args([]).hash_code
+    assert first != second
+    digest = hashing.file_digest(str(git_repo.join('data', 'cfg.txt')))
+    assert digest in git_repo.join(tracer.record_path, 'untracked.manifest').read()
+
+    # Snapshots are keyed on the full digest of the code state
+    snapshots = git_repo.join('lt_records', 'snapshots').listdir(lambda p: p.isdir())
+    assert len(snapshots) == 2
+    for snapshot in snapshots:
+        assert len(snapshot.basename.split('_')[-2]) == 32
+
+
+def test_background_record(git_repo):
+    git_repo.join('train.py').write('print("changed")\n')
+    git_repo.join('data.txt').write('data')
+
+    tracer = LTParser(background=True)
+    args = tracer.parse_args([])
+    tracer.flush()
+
+    assert not tracer.pending_records
+    record = git_repo.join('lt_records', args.hash_code)
+    assert 'changed' in record.join('diff.patch').read()
+    assert 'data.txt' in record.join('untracked.manifest').read()
+
+
+def edit_after_hashing(monkeypatch, path):
+    hash_unclean = LTParser._hash_unclean
+
+    def hash_then_edit(self, captured):
+        snapshot = hash_unclean(self, captured)
+        path.write(path.read() + ' edited')
+        return snapshot
+
+    monkeypatch.setattr(LTParser, '_hash_unclean', hash_then_edit)
+
+
+def test_changed_after_hashing(git_repo, monkeypatch):
+    git_repo.join('data.txt').write('data')
+    edit_after_hashing(monkeypatch, git_repo.join('data.txt'))
+
+    with pytest.raises(exceptions.RecordWriteError):
+        LTParser().parse_args([])
+    assert not git_repo.join('lt_records').listdir(lambda p: p.basename.startswith('LT_'))
+
+    # Content whose blob is not stored yet, a stored one is not copied again
+    git_repo.join('data.txt').write('other')
+    tracer = LTParser(background=True)
+    tracer.parse_args([])
+    with pytest.raises(exceptions.RecordWriteError):
+        tracer.flush()
+    assert not git_repo.join('lt_records').listdir(lambda p: p.basename.startswith('LT_'))
+
+
+def test_background_failure_at_exit(git_repo):
+    git_repo.join('data.txt').write('data')
+    script = ("import atexit\n"
+              "from lite_tracer import LTParser\n"
+              "atexit.register(print, 'user handler ran')\n"
+              "hash_unclean = LTParser._hash_unclean\n"
+              "def hash_then_edit(self, captured):\n"
+              "    snapshot = hash_unclean(self, captured)\n"
+              "    open('data.txt', 'w').write('edited')\n"
+              "    return snapshot\n"
+              "LTParser._hash_unclean = hash_then_edit\n"
+              "print(LTParser(background=True).parse_args([]).hash_code)\n"
+              "metrics = open('metrics.log', 'w')\n"
+              "metrics.write('loss 0.1')\n")
+
+    process = subprocess.Popen([sys.executable, '-c', script],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    # Reported, the program still exits normally
+    assert process.returncode == 0
+    assert out.decode('utf-8').startswith('LT_')
+    assert 'user handler ran' in out.decode('utf-8')
+    assert b'changed after it was hashed' in err
+    assert b'was not written' in err
+    assert git_repo.join('metrics.log').read() == 'loss 0.1'
+
+
+def test_concurrent_parse_args(git_repo):
+    git_repo.join('train.py').write('print("changed")\n')
+    git_repo.join('data.txt').write('data')
+    script = ("import sys\n"
+              "from lite_tracer import LTParser\n"
+              "parser = LTParser(on_suspicion='error')\n"
+              "parser.add_argument('--seed', type=int)\n"
+              "parser.parse_args(sys.argv[1:])\n")
+
+    processes = [subprocess.Popen([sys.executable, '-c', script, '--seed', str(i)])
+                 for i in range(8)]
+    assert all(p.wait() == 0 for p in processes)
+
+    records = git_repo.join('lt_records')
+    assert len(records.listdir('LT*LT')) == 8
+    assert len(records.join('snapshots').listdir('[!.]*')) == 1
+    assert not records.listdir('.tmp-*')
+
+
+def test_parse_many(git_repo):
+    git_repo.join('data.txt').write('data')
+    tracer = helper.get_tracer()
+    sysv_list = [helper.generate_sysv(i, False) for i in range(5)]
+
+    many = tracer.parse_many(sysv_list)
+    single = [helper.get_tracer().parse_args(sysv) for sysv in sysv_list]
+
+    assert [a.hash_code for a in many] == [a.hash_code for a in single]
+    assert [a.integer for a in many] == list(range(5))
+    assert tracer.args_file.endswith('settings_{}.txt'.format(many[-1].hash_code))
+    for args in many:
+        settings = git_repo.join('lt_records', args.hash_code,
+                                 'settings_{}.txt'.format(args.hash_code))
+        assert '--integer {}'.format(args.integer) in settings.read()
@@ -0,0 +1,70 @@
+import pytest
+
+import lite_tracer.exceptions as exception
+from lite_tracer import LTParser
+from lite_tracer.index import SearchIndex
+from lite_tracer.query import NEVER, NUMERIC, PRESENT, STRING, Pattern, Query, \
+    get_param_operator_value
+
+from helper import git_repo
+
+
+@pytest.fixture
+def search_index(git_repo):
+    parser = LTParser()
+    parser.add_argument('--lr', type=float, default=0.01)
+    parser.add_argument('--bsz', type=int, default=256)
+    parser.add_argument('--optimizer', default='sgd')
+    parser.add_argument('--flist', nargs='+', type=float, default=[6.01, 12.01])
+    parser.add_argument('--device', default='cuda:0')
+    parser.parse_args([])
+
+    search_index = SearchIndex(str(git_repo.join('lt_records')), ':memory:')
+    search_index.update()
+    return search_index
+
+
+def matches(search_index, include=(), exclude=()):
+    query = Query(get_param_operator_value(include),
+                  get_param_operator_value(exclude))
+    return len(search_index.select(query)) == 1
+
+
+def test_pattern():
+    pattern = Pattern(('<=', '0.01'))
+    assert (pattern.kind, pattern.value) == (NUMERIC, 0.01)
+    assert Pattern(('', '')).kind == PRESENT
+    assert Pattern((':', 'sgd')).kind == STRING
+    # Strings only match exactly
+    assert Pattern(('<', 'sgd')).kind == NEVER
+
+
+def test_include(search_index):
+    assert matches(search_index, ['lr'])
+    assert matches(search_index, ['lr<=0.01', 'bsz>=256'])
+    assert not matches(search_index, ['lr<0.01'])
+    assert matches(search_index, ['bsz==256.0', 'optimizer:sgd'])
+    assert not matches(search_index, ['optimizer:adam'])
+    # The query value is on the left, bsz<512 means 512 < bsz
+    assert not matches(search_index, ['bsz<512'])
+    # Any stored value matches, all patterns have to
+    assert matches(search_index, ['flist:6.01', 'flist>12'])
+    assert not matches(search_index, ['flist:6.01', 'flist<13'])
+    # Strings only match exactly, missing keys never match
+    assert not matches(search_index, ['optimizer<sgd'])
+    assert matches(search_index, ['device:cuda:0'])
+    assert not matches(search_index, ['lr', 'missing'])
+
+
+def test_exclude(search_index):
+    assert matches(search_index, exclude=['missing'])
+    assert not matches(search_index, exclude=['lr'])
+    assert not matches(search_index, exclude=['optimizer:adam', 'bsz>512'])
+    assert matches(search_index, exclude=['optimizer:adam', 'bsz<512'])
+    assert not matches(search_index, ['lr'], ['flist:12.01'])
+    assert matches(search_index)
+
+
+def test_unparsable():
+    with pytest.raises(exception.ArgumentNotParsable):
+        get_param_operator_value(['lr:'])
@@ -0,0 +1,125 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from lite_tracer import LTParser, backends, exceptions, packs
+from lite_tracer.restore import cached_worktree, restore
+
+from helper import git_repo
+
+GIT = ['git', '-c', 'user.name=lt', '-c', 'user.email=lt@lt']
+
+
+def read(path):
+    with open(str(path)) as read_file:
+        return read_file.read()
+
+
+@pytest.mark.parametrize('storage', ['dir', 'sqlite'])
+def test_restore(git_repo, storage):
+    git_repo.join('train.py').write('print("tuned")\n')
+    git_repo.join('data.txt').write('data')
+    first = LTParser(storage=storage).parse_args([]).hash_code
+
+    subprocess.check_output(GIT + ['commit', '-q', '-am', 'tune'])
+    git_repo.join('data.txt').remove()
+    second = LTParser(storage=storage).parse_args([]).hash_code
+    git_repo.join('train.py').write('print("later")\n')
+
+    lt_dir = str(git_repo.join('lt_records'))
+    storage = backends.open_storage(lt_dir, storage)
+    first_dir = restore(first, str(git_repo.join('first')), lt_dir, storage)
+    assert sorted(os.listdir(first_dir)) == ['data.txt', 'train.py']
+    assert read(os.path.join(first_dir, 'train.py')) == 'print("tuned")\n'
+    assert read(os.path.join(first_dir, 'data.txt')) == 'data'
+
+    second_dir = restore(second, lt_dir=lt_dir, storage=storage)
+    assert second_dir == os.path.join(lt_dir, 'restored', second)
+    assert os.listdir(second_dir) == ['train.py']
+    assert read(os.path.join(second_dir, 'train.py')) == 'print("tuned")\n'
+    assert os.stat(os.path.join(second_dir, 'train.py')).st_nlink == 1
+
+    linked_dir = restore(second, lt_dir=lt_dir, storage=storage, link=True)
+    assert os.stat(os.path.join(linked_dir, 'train.py')).st_nlink > 1
+
+    with pytest.raises(ValueError):
+        restore(first, first_dir, lt_dir, storage)
+    with pytest.raises(exceptions.NoRecordError):
+        restore('LT_missing_LT', lt_dir=lt_dir, storage=storage)
+
+
+def test_cached_worktree(git_repo):
+    git_repo.join('model.py').write('print("model")\n')
+    subprocess.check_output(GIT + ['add', 'model.py'])
+    subprocess.check_output(GIT + ['commit', '-q', '-m', 'model'])
+    git_repo.join('train.py').write('print("tuned")\n')
+    hash_code = LTParser().parse_args([]).hash_code
+    lt_dir = str(git_repo.join('lt_records'))
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+
+    restored = restore(hash_code, lt_dir=lt_dir, link=True)
+    worktree = cached_worktree(lt_dir, commit)
+    assert os.path.basename(worktree) == commit
+    # Patched files are replaced, the cache keeps the committed one
+    assert read(os.path.join(worktree, 'train.py')) == 'print("train")\n'
+
+    # A linked file edited in place is reset in the cache
+    with open(os.path.join(restored, 'model.py'), 'w') as edited:
+        edited.write('print("edited")\n')
+    restored = restore(hash_code, str(git_repo.join('again')), lt_dir)
+    assert read(os.path.join(restored, 'model.py')) == 'print("model")\n'
+    assert cached_worktree(lt_dir, commit) == worktree
+
+    # Copies by default, an edit in place stays in the restore
+    with open(os.path.join(restored, 'model.py'), 'w') as edited:
+        edited.write('print("edited")\n')
+    assert read(os.path.join(worktree, 'model.py')) == 'print("model")\n'
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_restore_legacy_untracked(git_repo, packed):
+    tracer = LTParser()
+    hash_code = tracer.parse_args([]).hash_code
+    # Records made before the blob store kept copies in untracked/
+    os.remove(os.path.join(tracer.record_path, 'untracked.manifest'))
+    git_repo.join(tracer.record_path, 'untracked', 'data.txt').write(
+        'data', ensure=True)
+    git_repo.join(tracer.record_path, 'untracked', 'cfg', 'a.json').write(
+        '{}', ensure=True)
+
+    lt_dir = str(git_repo.join('lt_records'))
+    if packed:
+        packs.pack_records(lt_dir, 0, now=time.time() + 1)
+
+    restored = restore(hash_code, lt_dir=lt_dir)
+    assert sorted(os.listdir(restored)) == ['cfg', 'data.txt', 'train.py']
+    assert read(os.path.join(restored, 'data.txt')) == 'data'
+    assert read(os.path.join(restored, 'cfg', 'a.json')) == '{}'
+
+
+def test_restore_command(git_repo, tmpdir_factory):
+    git_repo.join('train.py').write('print("tuned")\n')
+    git_repo.join('data.txt').write('data')
+    hash_code = LTParser().parse_args([]).hash_code
+
+    lt_dir = str(git_repo.join('lt_records'))
+    packs.pack_records(lt_dir, 0, now=time.time() + 1)
+
+    out = subprocess.check_output(['lite_trace.py', 'restore', hash_code,
+                                   '-o', 'restored'])
+    assert out.decode('utf-8').strip() == 'restored'
+    assert read(git_repo.join('restored', 'train.py')) == 'print("tuned")\n'
+    assert read(git_repo.join('restored', 'data.txt')) == 'data'
+    assert os.stat(str(git_repo.join('restored', 'train.py'))).st_nlink == 1
+
+    # git errors are reported without a traceback
+    not_a_repo = str(tmpdir_factory.mktemp('not_a_repo'))
+    process = subprocess.Popen(['lite_trace.py', 'restore', hash_code,
+                                '--repo', not_a_repo, '-o', 'elsewhere'],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    assert process.returncode == 1
+    assert out.decode('utf-8').startswith('Error: Commit')
+    assert b'Traceback' not in err
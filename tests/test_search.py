@@ -461,3 +461,18 @@ def test_search_parameter_and_value():
 #         else:
 #             with pytest.raises(RuntimeError):
 #                 output = helper.get_cmd_output(cmd)
+
+
+@pytest.mark.usefixtures("cleandir")
+def test_search_limit():
+    hash_codes = [helper.get_tracer().parse_args(helper.generate_sysv(i, False)).hash_code
+                  for i in range(4)]
+
+    output = helper.get_cmd_output("lite_trace.py -i integer --limit 2 --reverse")
+    assert [line.split(' ')[0] for line in output] == hash_codes[:1:-1]
+
+    output = helper.get_cmd_output("lite_trace.py -i integer -n 3")
+    assert [line.split(' ')[0] for line in output] == hash_codes[:3]
+
+    with pytest.raises(RuntimeError):
+        helper.get_cmd_output("lite_trace.py -i integer --since 2100-01-01")
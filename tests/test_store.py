@@ -0,0 +1,214 @@
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+import lite_tracer
+from lite_tracer import LTParser, backends, hashing, packs, store
+from helper import git_repo
+
+
+@pytest.mark.parametrize('algorithm', ['md5', 'blake2b'])
+def test_blob_store_dedup(tmpdir, algorithm):
+    work_dir = tmpdir.mkdir('work')
+    work_dir.join('a.txt').write('same content')
+    work_dir.mkdir('folder').join('b.txt').write('same content')
+    work_dir.join('c.bin').write_binary(b'\x00\xff' * 10)
+
+    blob_store = store.BlobStore(str(tmpdir.join('blobs')), algorithm)
+    with work_dir.as_cwd():
+        paths = ['a.txt', 'folder/', 'c.bin']
+        manifest = dict((p, blob_store.put(p)) for p in store.walk_files(paths))
+
+    assert len(manifest) == 3
+    assert len(set(manifest.values())) == 2
+
+    text = store.format_manifest(manifest, algorithm)
+    assert store.parse_manifest(text) == (manifest, algorithm)
+
+    restore_dir = str(tmpdir.join('restore'))
+    for path, digest in manifest.items():
+        restored = os.path.join(restore_dir, path)
+        blob_store.link(digest, restored)
+        assert hashing.file_digest(restored, algorithm) == digest
+        assert os.stat(restored).st_nlink > 1
+
+
+@pytest.mark.parametrize('record_format', ['dir', 'tar.gz', 'tar.xz'])
+def test_record_formats(git_repo, record_format):
+    git_repo.join('train.py').write('print("changed")\n')
+    git_repo.join('data.txt').write('data')
+
+    tracer = LTParser(record_format=record_format, compress_level=1)
+    args = tracer.parse_args([])
+
+    record_path = tracer.record_path
+    files = sorted(os.listdir(record_path))
+    settings = ['settings_{}.json'.format(args.hash_code),
+                'settings_{}.txt'.format(args.hash_code)]
+    if record_format == 'dir':
+        assert files == ['diff.patch'] + settings + ['untracked.manifest']
+    else:
+        assert files == ['record.' + record_format] + settings
+
+    assert 'changed' in store.read_patch(record_path)
+    assert list(store.read_manifest(record_path)[0]) == ['data.txt']
+
+
+def test_delta_patches(git_repo):
+    lines = ['print({})\n'.format(i) for i in range(200)]
+    git_repo.join('train.py').write(''.join(lines))
+    first = LTParser(delta_patches=True)
+    first.parse_args([])
+
+    lines[100] = 'print("tuned")\n'
+    git_repo.join('train.py').write(''.join(lines))
+    second = LTParser(delta_patches=True)
+    second.parse_args([])
+
+    git_diff = subprocess.check_output(['git', 'diff']).decode('utf-8')
+    delta_path = os.path.join(second.record_path, store.DELTA_FILE)
+    assert os.path.exists(delta_path)
+    assert os.path.getsize(delta_path) < len(git_diff) / 10
+    assert store.read_patch(second.record_path) == git_diff.rstrip('\n')
+    assert 'print(199)' in store.read_patch(first.record_path)
+
+
+def test_sharded_layout(git_repo):
+    git_repo.join('data.txt').write('data')
+    lines = ['print({})\n'.format(i) for i in range(200)]
+    git_repo.join('train.py').write(''.join(lines))
+
+    flat = LTParser(delta_patches=True)
+    flat_code = flat.parse_args([]).hash_code
+    lines[100] = 'print("tuned")\n'
+    git_repo.join('train.py').write(''.join(lines))
+    sharded = LTParser(delta_patches=True, sharded=True)
+    sharded_code = sharded.parse_args([]).hash_code
+
+    lt_dir = str(git_repo.join('lt_records'))
+    assert flat.record_path == os.path.join('lt_records', flat_code)
+    assert sharded.record_path == os.path.join(
+        'lt_records', store.shard_name(sharded_code), sharded_code)
+    assert 'tuned' in store.read_patch(sharded.record_path)
+
+    # New parsers follow the layout of lt_dir, both layouts are searched
+    follower = LTParser(on_suspicion='ignore')
+    assert follower.parse_args([]).hash_code == sharded_code
+    assert follower.record_path == sharded.record_path
+    assert store.find_record(lt_dir, sharded_code).endswith(
+        os.path.join(store.shard_name(sharded_code), sharded_code))
+    found = sorted(r.hash_str for r in lite_tracer.search(lt_dir))
+    assert found == sorted([flat_code, sharded_code])
+
+    assert store.reshard(lt_dir) == 1
+    assert not os.path.exists(os.path.join(lt_dir, flat_code))
+    assert store.reshard(lt_dir) == 0
+
+    record_path = store.find_record(lt_dir, flat_code)
+    assert 'print(199)' in store.read_patch(record_path)
+    assert list(store.read_manifest(record_path)[0]) == ['data.txt']
+
+    out = subprocess.check_output(['lite_trace.py', 'reshard', '--flat'])
+    assert out.decode('utf-8').strip() == 'moved 2 records'
+    assert not store.is_sharded(lt_dir)
+    assert sorted(n for n in os.listdir(lt_dir) if n.startswith('LT')) == \
+        sorted([flat_code, sharded_code])
+    assert sorted(r.hash_str for r in lite_tracer.search(lt_dir)) == found
+
+
+def test_pack_records(git_repo):
+    lines = ['print({})\n'.format(i) for i in range(200)]
+    git_repo.join('train.py').write(''.join(lines))
+    git_repo.join('data.txt').write('data')
+    records = list()
+    for options in [dict(delta_patches=True), dict(record_format='tar.gz')]:
+        lines.append('print("{}")\n'.format(len(records)))
+        git_repo.join('train.py').write(''.join(lines))
+        tracer = LTParser(**options)
+        args = tracer.parse_args([])
+        records.append((args.hash_code, store.read_patch(tracer.record_path)))
+
+    lt_dir = str(git_repo.join('lt_records'))
+    assert packs.pack_records(lt_dir, 1)[0] == 0
+    packed, pack_path = packs.pack_records(lt_dir, 1, now=time.time() + 2 * 86400)
+    assert packed == 2 and os.path.exists(pack_path)
+    assert not [n for n in os.listdir(lt_dir) if n.startswith('LT')]
+
+    storage = backends.LocalBackend(lt_dir)
+    for hash_code, patch in records:
+        assert storage.has_record(hash_code)
+        assert storage.read_patch(hash_code) == patch
+    found = dict((r.hash_str, r) for r in lite_tracer.search(lt_dir))
+    assert sorted(found) == sorted(h for h, _ in records)
+    for hash_code, patch in records:
+        assert found[hash_code].diff == patch
+        assert list(found[hash_code].untracked) == ['data.txt']
+        assert found[hash_code].settings['hash_code'] == hash_code
+
+    # A record written again is loose, and shadows its packed copy
+    args = LTParser(record_format='tar.gz', on_suspicion='ignore').parse_args([])
+    assert args.hash_code == records[1][0]
+    assert sorted(r.hash_str for r in lite_tracer.search(lt_dir)) == sorted(found)
+
+    out = subprocess.check_output(['lite_trace.py', 'pack', '--days', '0'])
+    assert out.decode('utf-8').startswith('packed 1 records into')
+    assert len(packs.load_packs(lt_dir)) == 2
+    assert sorted(r.hash_str for r in lite_tracer.search(lt_dir)) == sorted(found)
+
+
+def test_pack_legacy_record(git_repo, monkeypatch):
+    tracer = LTParser()
+    hash_code = tracer.parse_args([]).hash_code
+    # Records made before the blob store kept copies in untracked/
+    git_repo.join(tracer.record_path, 'untracked', 'sub', 'data.txt').write(
+        'data', ensure=True)
+
+    lt_dir = str(git_repo.join('lt_records'))
+    packed, pack_path = packs.pack_records(lt_dir, 0, now=time.time() + 1)
+    assert packed == 1
+    files = packs.Pack(pack_path).read(hash_code)
+    assert files['untracked/sub/data.txt'] == b'data'
+
+    # Packs are loaded once, and again only when one was added
+    loads = list()
+    load_packs = packs.load_packs
+
+    def counted_load_packs(lt_dir):
+        loads.append(lt_dir)
+        return load_packs(lt_dir)
+
+    monkeypatch.setattr(packs, 'load_packs', counted_load_packs)
+    storage = backends.LocalBackend(lt_dir)
+    for _ in range(3):
+        assert storage.has_record(hash_code)
+        assert not storage.has_record('LT_missing_LT')
+    assert len(loads) == 1
+
+    tracer = LTParser()
+    tracer.add_argument('--seed', type=int)
+    other = tracer.parse_args(['--seed', '1']).hash_code
+    packs.pack_records(lt_dir, 0, now=time.time() + 1)
+    assert storage.has_record(other)
+    assert loads.count(lt_dir) == 2
+
+
+def test_overwrite_waits_for_pack(tmpdir):
+    lt_dir = str(tmpdir.mkdir('lt_records'))
+    storage = backends.LocalBackend(lt_dir)
+    storage.write_record('LT1LT', [('settings_LT1LT.txt', '--lr 0.1\n')])
+
+    # A pack renaming the record aside would make the replaces fail
+    writer = threading.Thread(target=storage.write_record, args=(
+        'LT1LT', [('settings_LT1LT.txt', '--lr 0.2\n')]))
+    tmpdir.join('lt_records', packs.PACKS_DIR).ensure(dir=True)
+    with store.FileLock(packs.lock_path(lt_dir)):
+        writer.start()
+        writer.join(0.5)
+        assert writer.is_alive()
+        assert storage.read_file('LT1LT', 'settings_LT1LT.txt') == '--lr 0.1\n'
+
+    writer.join()
+    assert storage.read_file('LT1LT', 'settings_LT1LT.txt') == '--lr 0.2\n'